@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sys
+import atexit
 import logging
 
 import pandas
@@ -20,6 +21,85 @@ ch.setLevel(logging.DEBUG)
 logger.addHandler(ch)
 
 
+def store_manifest(syn, metadata_manifest, storage_location, args, file_view=None, header=True,
+                   journal=None, md5_index=None):
+    """Create file handles and store entities for a manifest or a chunk of one."""
+
+    if args.shard:
+        metadata_manifest = metadata_manifest[ndasynapse.shard.in_shard(metadata_manifest.data_file,
+                                                                        args.shard)].copy()
+
+    if journal is not None:
+        metadata_manifest = journal.pending(metadata_manifest)
+
+    synapse_manifest = metadata_manifest
+    synapse_manifest['path'] = None
+
+    try:
+        fh_names = metadata_manifest['fileName']
+    except KeyError:
+        logger.info("No column 'filename', using 'data_file' column.")
+        fh_names = list(map(synapseclient.utils.guess_file_name,
+                            metadata_manifest.data_file.tolist()))
+
+    synapse_manifest['name'] = fh_names
+
+    synapse_manifest['parentId'] = args.synapse_data_folder
+
+    if file_view is not None:
+        plan = ndasynapse.synapse.plan_store(synapse_manifest, file_view)
+
+        if args.bulk_annotations:
+            updates = plan.action == ndasynapse.synapse.PLAN_UPDATE
+
+            if args.dry_run:
+                logger.info("Would update annotations of %s entities in the file view." % (updates.sum(), ))
+            else:
+                ndasynapse.synapse.update_annotations(syn, synapse_manifest[updates], args.file_view_id,
+                                                      plan.id[updates], batch_size=args.bulk_batch_size,
+                                                      journal=journal)
+
+            # New files and new versions of changed files still have to be stored
+            synapse_manifest = synapse_manifest[plan.action.isin([ndasynapse.synapse.PLAN_CREATE,
+                                                                  ndasynapse.synapse.PLAN_REPLACE])]
+        else:
+            synapse_manifest = synapse_manifest[plan.action != ndasynapse.synapse.PLAN_NOOP]
+
+    if args.verify_s3:
+        verified = ndasynapse.s3.verify_s3_objects(synapse_manifest, storage_location,
+                                                   max_workers=args.s3_workers,
+                                                   compute_md5_multipart=args.compute_md5)
+        bad = verified.s3_status != ndasynapse.s3.STATUS_OK
+
+        if bad.any():
+            for data_file, status in zip(synapse_manifest.data_file[bad], verified.s3_status[bad]):
+                logger.error("S3 object %s: %s" % (data_file, status))
+
+            if not args.ignore_errors:
+                raise ValueError("%s S3 objects are missing or do not match the manifest." % (bad.sum(), ))
+
+            synapse_manifest = synapse_manifest[~bad]
+
+    fh_list = ndasynapse.synapse.create_synapse_filehandles(syn=syn,
+                                                            metadata_manifest=synapse_manifest,
+                                                            storage_location=storage_location,
+                                                            verbose=args.verbose,
+                                                            md5_index=md5_index)
+    fh_ids = [x.get('id', None) for x in fh_list]
+
+    synapse_manifest = synapse_manifest.assign(dataFileHandleId=fh_ids)
+
+    if not args.dry_run:
+        f_list = ndasynapse.synapse.store(syn=syn,
+                                          synapse_manifest=synapse_manifest,
+                                          filehandles=fh_list, ignore_errors=args.ignore_errors,
+                                          journal=journal)
+
+        sys.stderr.write("%s\n" % (f_list, ))
+    else:
+        synapse_manifest.to_csv(sys.stdout, index=False, header=header, encoding='utf-8')
+
+
 def main():
 
     import argparse
@@ -30,49 +110,92 @@ def main():
     parser.add_argument("--ignore_errors", action="store_true", default=False)
     parser.add_argument("--storage_location_id", type=str)
     parser.add_argument("--synapse_data_folder", type=str)
-    parser.add_argument("manifest_file", type=str)
+    parser.add_argument("--file_view_id", type=str, default=None,
+                        help="File view to compare against, so only new or changed rows are stored.")
+    parser.add_argument("--bulk_annotations", action="store_true", default=False,
+                        help="With --file_view_id, update annotations of existing entities as file view row changes in batched transactions.")
+    parser.add_argument("--bulk_batch_size", type=int, default=5000,
+                        help="Number of entities per file view transaction for --bulk_annotations. [default: %(default)s]")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Read, resolve and store the manifest this many rows at a time.")
+    parser.add_argument("--journal", type=str, default=None,
+                        help="Journal file recording stored rows. Rerunning with the same journal resumes where it stopped.")
+    parser.add_argument("--md5_index_view", type=str, default=None,
+                        help="File view to build a local md5 index from, used before looking up md5s in Synapse.")
+    parser.add_argument("--verify_s3", action="store_true", default=False,
+                        help="Check that each S3 object exists and matches the manifest size and md5 before storing.")
+    parser.add_argument("--s3_workers", type=int, default=16,
+                        help="Number of concurrent S3 requests for --verify_s3. [default: %(default)s]")
+    parser.add_argument("--compute_md5", action="store_true", default=False,
+                        help="With --verify_s3, compute the md5 of multipart objects, whose ETag is not an md5.")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="Only store the rows in shard i/N (0 <= i < N), assigned by data_file.")
+    parser.add_argument("--input_format", type=str, default="csv", choices=["csv", "ndjson"],
+                        help="Format of the manifest. With ndjson, each batch (ended by a blank line) is stored as soon as it is read. [default: %(default)s]")
+    parser.add_argument("manifest_file", type=str,
+                        help="Manifest file, or - to read from stdin.")
+
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace event timeline of the run to this file.")
 
     args = parser.parse_args()
 
+    atexit.register(ndasynapse.client.log_flight_stats)
+
+    if args.trace:
+        ndasynapse.trace.enable()
+        atexit.register(ndasynapse.trace.export_chrome_trace, args.trace)
+
+    if args.bulk_annotations and not args.file_view_id:
+        parser.error("--bulk_annotations requires --file_view_id.")
+
     syn = synapseclient.Synapse(skip_checks=True)
     syn.login(silent=True)
 
     # get existing storage location object
     storage_location = syn.restGET("/storageLocation/%(storage_location_id)s" % dict(storage_location_id=args.storage_location_id))
 
-    metadata_manifest = pandas.read_csv(args.manifest_file)
+    if args.file_view_id:
+        file_view = ndasynapse.synapse.get_file_view(syn, args.file_view_id,
+                                                     parent_id=args.synapse_data_folder)
+    else:
+        file_view = None
 
-    fh_list = ndasynapse.synapse.create_synapse_filehandles(syn=syn,
-                                                            metadata_manifest=metadata_manifest,
-                                                            storage_location=storage_location,
-                                                            verbose=args.verbose)
-    fh_ids = map(lambda x: x.get('id', None), fh_list)
+    if args.md5_index_view:
+        md5_index = ndasynapse.index.Md5Index(syn, args.md5_index_view)
+        md5_index.refresh()
+    else:
+        md5_index = None
 
-    synapse_manifest = metadata_manifest
-    synapse_manifest['dataFileHandleId'] = fh_ids
-    synapse_manifest['path'] = None
+    if args.journal and not args.dry_run:
+        journal = ndasynapse.journal.StoreJournal(args.journal)
+    else:
+        journal = None
 
-    try:
-        fh_names = metadata_manifest['fileName']
-    except KeyError:
-        logger.info("No column 'filename', using 'data_file' column.")
-        fh_names = map(synapseclient.utils.guess_file_name,
-                       metadata_manifest.data_file.tolist())
+    manifest_file = sys.stdin if args.manifest_file == "-" else args.manifest_file
 
-    synapse_manifest['name'] = fh_names
+    if args.input_format == "ndjson":
+        lines = sys.stdin if manifest_file is sys.stdin else open(manifest_file)
+        chunks = ndasynapse.stream.iter_batches(lines, chunksize=args.chunksize)
+    elif args.chunksize:
+        chunks = pandas.read_csv(manifest_file, chunksize=args.chunksize)
+    else:
+        chunks = [pandas.read_csv(manifest_file)]
 
-    synapse_manifest['parentId'] = args.synapse_data_folder
+    stored = 0
 
-    if not args.dry_run:
-        syn = synapseclient.login(silent=True)
+    for n, metadata_manifest in enumerate(chunks):
+        if args.chunksize or args.input_format == "ndjson":
+            logger.info("Storing rows %s to %s." % (stored, stored + metadata_manifest.shape[0]))
 
-        f_list = ndasynapse.synapse.store(syn=syn,
-                                          synapse_manifest=synapse_manifest,
-                                          filehandles=fh_list, ignore_errors=args.ignore_errors)
+        stored += metadata_manifest.shape[0]
 
-        sys.stderr.write("%s\n" % (f_list, ))
-    else:
-        synapse_manifest.to_csv("/dev/stdout", index=False, encoding='utf-8')
+        store_manifest(syn, metadata_manifest, storage_location, args,
+                       file_view=file_view, header=(n == 0), journal=journal,
+                       md5_index=md5_index)
+
+    if journal is not None:
+        journal.close()
 
 
 if __name__ == "__main__":
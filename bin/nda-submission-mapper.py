@@ -1,7 +1,7 @@
 import json
-from io import StringIO
 import pandas
 import requests
+import ndasynapse
 
 
 # class ApplicationProperties:
@@ -149,20 +149,13 @@ class NDASubmission:
 if __name__ == "__main__":
     config = json.load(open("/home/kdaily/ndalogs_config.json"))['nda']
     submissions = NDASubmission(config=config, collection_id=2963)
+    data_frames = ndasynapse.nda.get_submission_data_frames(submissions.submission_files)
     for submission in submissions.submission_files:
         print('GUIDs from submission {} in collection {}'.
               format(submission['submission_id'],
                      submission['collection_id']))
-        for data_file in submission['files'].data_files:
-            data_file_as_string = data_file['content'].decode('utf-8')
-            if 'genomics_subject' in data_file_as_string:
-                subject_data = pandas.read_csv(StringIO(data_file_as_string), skiprows=[1])
-            if 'genomics_sample' in data_file_as_string:
-                sample_data = pandas.read_csv(StringIO(data_file_as_string), skiprows=[1])
-            if 'nichd_btb' in data_file_as_string:
-                nichd_data = pandas.read_csv(StringIO(data_file_as_string), skiprows=[1])
         associated_files = pandas.DataFrame.from_dict(submission['files'].associated_files)
         print(associated_files)
-        print(subject_data)
-        print(sample_data)
-        print(nichd_data)
+    print(data_frames.get('genomics_subject02'))
+    print(data_frames.get('genomics_sample03'))
+    print(data_frames.get('nichd_btb02'))
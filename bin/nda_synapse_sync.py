@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""Sync NDA GUID metadata and data files to Synapse in one pipelined run.
+
+Fetching GUIDs from NDA, processing them, assembling manifest rows, getting
+file handles and storing entities run as concurrent stages joined by bounded
+queues, so each GUID moves on to the next stage as soon as it is ready.
+
+"""
+
+import sys
+import json
+import atexit
+import pickle
+import logging
+import threading
+import concurrent.futures
+
+import synapseclient
+import ndasynapse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+class Sync:
+    """The stages of a sync, sharing the clients and state they need."""
+
+    def __init__(self, auth, syn, storage_location, args, file_view=None, journal=None, md5_index=None,
+                 process_executor=None, prefetcher=None):
+        self.auth = auth
+        self.syn = syn
+        self.storage_location = storage_location
+        self.args = args
+        self.file_view = file_view
+        self.journal = journal
+        self.md5_index = md5_index
+        self.process_executor = process_executor
+        self.prefetcher = prefetcher
+        self.dataset_ids = args.dataset_ids or None
+        self.resolver = ndasynapse.resolver.FilenameResolver(ndasynapse.synapse.PROJECT_ID, syn=syn,
+                                                             registry_path=args.name_registry)
+        self.stopped = threading.Event()
+        self._finished = {}
+        self._position = 0
+        self._released = threading.Condition()
+
+    def fetch(self, item):
+        """Get a GUID's data from NDA, or None if it has no samples in `--dataset_ids`.
+
+        Items are (position, GUID) pairs, and skipped GUIDs are still passed
+        on so `assemble` can keep the order of `--guids`. A GUID is only
+        fetched once it is less than `--queue_size` GUIDs ahead of the next
+        one to assemble, so a slow GUID holds back the GUIDs after it
+        instead of letting them pile up waiting to be assembled.
+
+        """
+
+        position, guid = item
+
+        with self._released:
+            while position >= self._position + self.args.queue_size and not self.stopped.is_set():
+                self._released.wait(ndasynapse.pipeline.POLL_SECONDS)
+
+        if self.stopped.is_set():
+            return []
+
+        guid_data = ndasynapse.nda.get_guid_data(self.auth, guid, dataset_ids=self.dataset_ids)
+
+        return [(position, guid, guid_data)]
+
+    def process(self, item):
+        position, guid, guid_data = item
+
+        if guid_data is None:
+            return [(position, guid, None)]
+
+        if self.process_executor is not None:
+            processed = self.process_executor.submit(ndasynapse.nda.process_guid_data_pickled, guid_data,
+                                                     ndasynapse.nda.EXCLUDE_GENOMICS_SUBJECTS,
+                                                     self.dataset_ids).result()
+            samples, subjects, tissues = pickle.loads(processed)
+        else:
+            samples, subjects, tissues = ndasynapse.nda.process_guid_data(guid_data,
+                                                                          ndasynapse.nda.EXCLUDE_GENOMICS_SUBJECTS,
+                                                                          self.dataset_ids)
+
+        logger.debug("Processed samples, subjects and tissues for %s" % guid)
+
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch_samples(samples)
+
+        return [(position, guid, (ndasynapse.nda.fix_samples(samples), subjects, tissues))]
+
+    def assemble(self, item):
+        """Make the Synapse manifest rows of each GUID that is ready, in the order of `--guids`.
+
+        Runs on a single worker, as file names are resolved one GUID at a
+        time. A GUID processed before the GUIDs ahead of it waits here, so
+        file naming doesn't depend on which requests finish first.
+
+        """
+
+        position, guid, guid_data = item
+        self._finished[position] = (guid, guid_data)
+
+        manifests = []
+
+        while self._position in self._finished:
+            guid, guid_data = self._finished.pop(self._position)
+
+            with self._released:
+                self._position += 1
+                self._released.notify_all()
+
+            if guid_data is not None:
+                manifests.extend(self._assemble(guid, *guid_data))
+
+        return manifests
+
+    def _assemble(self, guid, samples, subjects, tissues):
+        """Merge a GUID's metadata and make its Synapse manifest rows."""
+
+        btb_subjects = ndasynapse.nda.merge_tissues_subjects(tissues, subjects)
+        metadata = ndasynapse.nda.merge_tissues_samples(btb_subjects, samples)
+
+        if metadata.shape[0] == 0:
+            return []
+
+        if self.args.get_experiments:
+            metadata = ndasynapse.nda.merge_experiments(self.auth, metadata, verbose=self.args.verbose,
+                                                        prefetcher=self.prefetcher)
+
+        metadata = self.resolver.resolve(metadata)
+        metadata['consortium'] = "BSMN"
+
+        if self.journal is not None:
+            metadata = self.journal.pending(metadata)
+
+        metadata = metadata.assign(name=metadata.fileName, parentId=self.args.synapse_data_folder, path=None)
+
+        if self.file_view is not None:
+            plan = ndasynapse.synapse.plan_store(metadata, self.file_view)
+            metadata = metadata[plan.action != ndasynapse.synapse.PLAN_NOOP]
+
+        if metadata.shape[0] == 0:
+            return []
+
+        logger.info("Assembled %s rows for %s." % (metadata.shape[0], guid))
+
+        return [metadata]
+
+    def file_handles(self, manifest):
+        fh_list = ndasynapse.synapse.create_synapse_filehandles(syn=self.syn,
+                                                                metadata_manifest=manifest,
+                                                                storage_location=self.storage_location,
+                                                                verbose=self.args.verbose,
+                                                                md5_index=self.md5_index)
+
+        manifest = manifest.assign(dataFileHandleId=[x.get('id', None) for x in fh_list])
+
+        return [(manifest, fh_list)]
+
+    def store(self, item):
+        manifest, fh_list = item
+
+        if self.args.dry_run:
+            return [manifest]
+
+        ndasynapse.synapse.store(syn=self.syn, synapse_manifest=manifest, filehandles=fh_list,
+                                 verbose=self.args.verbose, ignore_errors=self.args.ignore_errors,
+                                 journal=self.journal)
+
+        return [manifest]
+
+    def stages(self):
+        return [ndasynapse.pipeline.Stage("fetch", self.fetch, workers=self.args.fetch_workers),
+                ndasynapse.pipeline.Stage("process", self.process,
+                                          workers=self.args.process_workers or self.args.processes or 1),
+                ndasynapse.pipeline.Stage("assemble", self.assemble, workers=1),
+                ndasynapse.pipeline.Stage("file_handles", self.file_handles,
+                                          workers=self.args.file_handle_workers),
+                ndasynapse.pipeline.Stage("store", self.store, workers=self.args.store_workers)]
+
+
+def main():
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verbose", action="store_true", default=False)
+    parser.add_argument("--dry_run", action="store_true", default=False,
+                        help="Write the rows that would be stored as newline-delimited JSON instead of storing them.")
+    parser.add_argument("--ignore_errors", action="store_true", default=False)
+    parser.add_argument("--config", type=str, default=None)
+    parser.add_argument("--guids", type=str, nargs="+", required=True,
+                        help="GUIDs to sync.")
+    parser.add_argument("--dataset_ids", default=None, nargs="*",
+                        help="Only sync samples in these NDA datasets.")
+    parser.add_argument("--get_experiments", action="store_true", default=False)
+    parser.add_argument("--experiment_workers", type=int, default=4,
+                        help="Number of experiments to request from NDA at once, starting as soon as their samples are processed. [default: %(default)s]")
+    parser.add_argument("--storage_location_id", type=str)
+    parser.add_argument("--synapse_data_folder", type=str)
+    parser.add_argument("--file_view_id", type=str, default=None,
+                        help="File view to compare against, so only new or changed rows are stored.")
+    parser.add_argument("--journal", type=str, default=None,
+                        help="Journal file recording stored rows. Rerunning with the same journal resumes where it stopped.")
+    parser.add_argument("--md5_index_view", type=str, default=None,
+                        help="File view to build a local md5 index from, used before looking up md5s in Synapse.")
+    parser.add_argument("--name_registry", type=str, default=None,
+                        help="CSV file of file names already assigned in Synapse, updated with new names.")
+    parser.add_argument("--fetch_workers", type=int, default=4,
+                        help="Number of GUIDs to request from NDA at once. [default: %(default)s]")
+    parser.add_argument("--process_workers", type=int, default=None,
+                        help="Number of GUIDs to decode and process at once. [default: --processes, or 1]")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="Number of worker processes for decoding and processing. [default: in this process]")
+    parser.add_argument("--file_handle_workers", type=int, default=2,
+                        help="Number of batches to look up md5s and make file handles for at once. [default: %(default)s]")
+    parser.add_argument("--store_workers", type=int, default=2,
+                        help="Number of batches to store in Synapse at once. [default: %(default)s]")
+    parser.add_argument("--queue_size", type=int, default=8,
+                        help="Number of items waiting between stages before the earlier stage blocks, and of GUIDs fetched ahead of the next one to assemble. [default: %(default)s]")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace event timeline of the run to this file.")
+
+    args = parser.parse_args()
+
+    atexit.register(ndasynapse.client.log_flight_stats)
+
+    if args.trace:
+        ndasynapse.trace.enable()
+        atexit.register(ndasynapse.trace.export_chrome_trace, args.trace)
+
+    config = json.load(open(args.config))
+    auth = ndasynapse.nda.authenticate(config)
+
+    syn = synapseclient.Synapse(skip_checks=True)
+    syn.login(silent=True)
+
+    storage_location = syn.restGET("/storageLocation/%(storage_location_id)s" % dict(storage_location_id=args.storage_location_id))
+
+    if args.file_view_id:
+        file_view = ndasynapse.synapse.get_file_view(syn, args.file_view_id,
+                                                     parent_id=args.synapse_data_folder)
+    else:
+        file_view = None
+
+    if args.md5_index_view:
+        md5_index = ndasynapse.index.Md5Index(syn, args.md5_index_view)
+        md5_index.refresh()
+    else:
+        md5_index = None
+
+    if args.journal and not args.dry_run:
+        journal = ndasynapse.journal.StoreJournal(args.journal)
+    else:
+        journal = None
+
+    process_executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) if args.processes else None
+
+    if args.get_experiments:
+        prefetcher = ndasynapse.nda.ExperimentPrefetcher(auth, max_workers=args.experiment_workers)
+    else:
+        prefetcher = None
+
+    sync = Sync(auth, syn, storage_location, args, file_view=file_view, journal=journal,
+                md5_index=md5_index, process_executor=process_executor, prefetcher=prefetcher)
+
+    stored = 0
+
+    try:
+        for manifest in ndasynapse.pipeline.run(enumerate(args.guids), sync.stages(), maxsize=args.queue_size,
+                                                stopped=sync.stopped):
+            stored += manifest.shape[0]
+
+            if args.dry_run:
+                ndasynapse.stream.write_batch(manifest, sys.stdout)
+    finally:
+        sync.resolver.save()
+
+        if process_executor is not None:
+            process_executor.shutdown()
+
+        if prefetcher is not None:
+            prefetcher.shutdown()
+
+        if journal is not None:
+            journal.close()
+
+    logger.info("%s %s rows." % ("Would store" if args.dry_run else "Stored", stored))
+
+
+if __name__ == "__main__":
+    main()
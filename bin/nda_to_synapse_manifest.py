@@ -1,14 +1,11 @@
 #!/usr/bin/env python
 
-import os
-import json
+import sys
+import atexit
+import collections
 import logging
-import uuid
 
-import requests
 import pandas
-import boto3
-import synapseclient
 import ndasynapse
 
 pandas.options.display.max_rows = None
@@ -26,17 +23,206 @@ logger.addHandler(ch)
 # NDA Configuration
 REFERENCE_GUID = 'NDAR_INVRT663MBL'
 
-# This is an old genomics subject
-EXCLUDE_GENOMICS_SUBJECTS = ('92027', )
-
 NDA_BUCKET_NAME = 'nda-bsmn'
 
 # Synapse configuration
 storage_location_id = '9209'
-PROJECT_ID = 'syn5902559'
 UUID_COLUMNS = ['sample_id_biorepository', 'sample_id_original',
                 'experiment_id', 'datasetid']
 
+def get_collection_tables(config, args, prefetcher=None):
+    """Get the processed samples, subjects and tissues of NDA collections from their submissions."""
+
+    (samples, subjects, btb) = ndasynapse.nda.get_collection_metadata(config['nda'],
+                                                                      args.collection_ids)
+
+    if args.dataset_ids:
+        samples = ndasynapse.nda.filter_dataset_ids(samples, args.dataset_ids)
+        subjects = subjects[subjects.subjectkey.isin(samples.subjectkey)]
+        btb = btb[btb.subjectkey.isin(samples.subjectkey)]
+
+    samples = ndasynapse.nda.process_samples(samples)
+
+    if samples.shape[0] == 0:
+        # Nothing to merge the subjects and tissues with
+        logger.info("No samples in collections %s." % (args.collection_ids, ))
+        return samples, subjects, btb
+
+    samples = ndasynapse.nda.fix_samples(samples)
+
+    if prefetcher is not None:
+        prefetcher.prefetch_samples(samples)
+
+    subjects = ndasynapse.nda.process_subjects(subjects, ndasynapse.nda.EXCLUDE_GENOMICS_SUBJECTS)
+    btb = ndasynapse.nda.process_tissues(btb)
+
+    return samples, subjects, btb
+
+def get_metadata(auth, config, args, prefetcher=None):
+    """Get the merged samples, subjects and tissues metadata from NDA.
+
+    If an `ExperimentPrefetcher` is given, it is sent the experiments of the
+    samples as they arrive.
+
+    """
+
+    samples = pandas.DataFrame()
+    subjects = pandas.DataFrame()
+    btb = pandas.DataFrame()
+    
+    if args.source == "submissions":
+        (samples, subjects, btb) = get_collection_tables(config, args, prefetcher=prefetcher)
+        guids = []
+
+        if args.shard:
+            samples = samples[ndasynapse.shard.in_shard(samples.subjectkey, args.shard)]
+    else:
+        guids = args.guids
+
+    if args.shard:
+        guids = [guid for (guid, keep) in zip(guids, ndasynapse.shard.in_shard(guids, args.shard)) if keep]
+        logger.info("Processing %s GUIDs in shard %s." % (len(guids), args.shard))
+
+    guid_data = {}
+
+    for (guid, samples_guid, subjects_guid, btb_guid) in ndasynapse.nda.iter_guid_data(auth, guids,
+                                                                                     max_workers=args.threads,
+                                                                                     processes=args.processes,
+                                                                                     exclude_genomics_subjects=ndasynapse.nda.EXCLUDE_GENOMICS_SUBJECTS,
+                                                                                     dataset_ids=args.dataset_ids or None):
+        if samples_guid is None:
+            continue
+
+        logging.debug("Processed samples, subjects and tissues for %s" % guid)
+        guid_data[guid] = (ndasynapse.nda.fix_samples(samples_guid), subjects_guid, btb_guid)
+
+        if prefetcher is not None:
+            prefetcher.prefetch_samples(samples_guid)
+
+    if guid_data:
+        samples = pandas.concat([samples] + [guid_data[guid][0] for guid in guids if guid in guid_data])
+        subjects = pandas.concat([subjects] + [guid_data[guid][1] for guid in guids if guid in guid_data])
+        btb = pandas.concat([btb] + [guid_data[guid][2] for guid in guids if guid in guid_data])
+
+    if samples.shape[0] == 0:
+        logger.info("No samples to get metadata for.")
+        return ndasynapse.nda.empty_metadata()
+
+    btb_subjects = ndasynapse.nda.merge_tissues_subjects(btb, subjects)    
+    metadata = ndasynapse.nda.merge_tissues_samples(btb_subjects, samples)
+
+    return metadata
+
+def iter_guid_metadata(auth, guids, args, prefetcher=None):
+    """Yield the merged metadata of each GUID, in the order of `guids`.
+
+    A GUID's metadata is yielded as soon as it and the GUIDs before it are
+    processed, so output order (and so file naming) doesn't depend on which
+    requests finish first. GUIDs skipped for `--dataset_ids` yield nothing.
+
+    """
+
+    def merged(guid_data):
+        (samples, subjects, btb) = guid_data
+
+        if samples.shape[0] == 0:
+            return ndasynapse.nda.empty_metadata()
+
+        btb_subjects = ndasynapse.nda.merge_tissues_subjects(btb, subjects)
+        return ndasynapse.nda.merge_tissues_samples(btb_subjects, samples)
+
+    finished = {}
+    position = 0
+
+    for (guid, samples_guid, subjects_guid, btb_guid) in ndasynapse.nda.iter_guid_data(auth, guids,
+                                                                                     max_workers=args.threads,
+                                                                                     processes=args.processes,
+                                                                                     exclude_genomics_subjects=ndasynapse.nda.EXCLUDE_GENOMICS_SUBJECTS,
+                                                                                     dataset_ids=args.dataset_ids or None):
+        if samples_guid is None:
+            finished[guid] = None
+        else:
+            logging.debug("Processed samples, subjects and tissues for %s" % guid)
+            finished[guid] = (ndasynapse.nda.fix_samples(samples_guid), subjects_guid, btb_guid)
+
+            if prefetcher is not None:
+                prefetcher.prefetch_samples(samples_guid)
+
+        while position < len(guids) and guids[position] in finished:
+            guid_data = finished.pop(guids[position])
+            position += 1
+
+            if guid_data is not None:
+                yield merged(guid_data)
+
+    # Whatever couldn't be released in order, still in the order of `guids`
+    for guid in guids[position:]:
+        guid_data = finished.pop(guid, None)
+
+        if guid_data is not None:
+            yield merged(guid_data)
+
+
+def stream_manifest(auth, config, args, out, prefetcher=None):
+    """Write the manifest rows of each GUID as a batch of newline-delimited JSON as soon as they are ready.
+
+    With '--source submissions', the batches are the partitions of an out of
+    core merge if --join_partitions is set, otherwise the whole manifest.
+    Rows of data files already in --name_registry are written as soon as they
+    are ready. Rows of new data files are held back and named together in a
+    last batch, so files get the same names as without --stream.
+
+    """
+
+    if args.source == "submissions":
+        (samples, subjects, btb) = get_collection_tables(config, args, prefetcher=prefetcher)
+
+        if samples.shape[0] == 0:
+            logger.info("No samples to get metadata for.")
+            batches = []
+        elif args.join_partitions:
+            btb_subjects = ndasynapse.nda.merge_tissues_subjects(btb, subjects)
+            batches = ndasynapse.nda.iter_merge_tissues_samples(btb_subjects, samples,
+                                                                partitions=args.join_partitions)
+        else:
+            btb_subjects = ndasynapse.nda.merge_tissues_subjects(btb, subjects)
+            batches = [ndasynapse.nda.merge_tissues_samples(btb_subjects, samples)]
+    else:
+        guids = list(collections.OrderedDict.fromkeys(args.guids))
+        batches = iter_guid_metadata(auth, guids, args, prefetcher=prefetcher)
+
+    resolver = ndasynapse.resolver.FilenameResolver(ndasynapse.synapse.PROJECT_ID,
+                                                    registry_path=args.name_registry)
+
+    new = []
+
+    for metadata in batches:
+        if metadata.shape[0] == 0:
+            continue
+
+        if args.get_experiments:
+            metadata = ndasynapse.nda.merge_experiments(auth, metadata, verbose=args.verbose,
+                                                        prefetcher=prefetcher)
+
+        (named, unnamed) = resolver.split_named(metadata)
+        new.append(unnamed)
+
+        if named.shape[0] > 0:
+            named['consortium'] = "BSMN"
+            ndasynapse.stream.write_batch(named, out)
+
+    new = [x for x in new if x.shape[0] > 0]
+
+    if new:
+        logger.info("Naming %s rows of new data files." % (sum(x.shape[0] for x in new), ))
+        metadata = resolver.resolve(pandas.concat(new, ignore_index=True))
+        metadata['consortium'] = "BSMN"
+
+        ndasynapse.stream.write_batch(metadata, out)
+
+    resolver.save()
+
+
 def main():
 
     import argparse
@@ -46,14 +232,59 @@ def main():
     parser.add_argument("--verbose", action="store_true", default=False)
     parser.add_argument("--guids", type=str, default=REFERENCE_GUID, nargs="+",
                         help="GUID to search for. [default: %(default)s]")
+    parser.add_argument("--source", type=str, default="guid", choices=["guid", "submissions"],
+                        help="Get metadata from the GUID API for each GUID, or from the submission data files of whole collections. [default: %(default)s]")
+    parser.add_argument("--collection_ids", type=int, default=[], nargs="+",
+                        help="NDA collections to get metadata for with '--source submissions'.")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of GUIDs to request from NDA at once. [default: %(default)s]")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="Number of worker processes for decoding and processing GUID data. [default: in this process]")
     parser.add_argument("--get_experiments", action="store_true", default=False)
+    parser.add_argument("--experiment_workers", type=int, default=4,
+                        help="Number of experiments to request from NDA at once with --get_experiments, starting as soon as their samples arrive. [default: %(default)s]")
     parser.add_argument("--synapse_data_folder", nargs=1)
     parser.add_argument("--uuid_columns", type=str, default=None)
-    parser.add_argument("--dataset_ids", default=None, nargs="*")
+    parser.add_argument("--dataset_ids", default=None, nargs="*",
+                        help="Only get metadata for samples in these NDA datasets. GUIDs without any are skipped after their samples are requested.")
     parser.add_argument("--config", type=str, default=None)
+    parser.add_argument("--name_registry", type=str, default=None,
+                        help="CSV file of file names already assigned in Synapse, updated with new names.")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="Only process the GUIDs (subjectkeys with '--source submissions') in shard i/N (0 <= i < N), and write the metadata before getting experiments and naming files.")
+    parser.add_argument("--merge_shards", type=str, default=None, nargs="+",
+                        help="Combine the outputs of --shard runs, then get experiments and name files across all of them.")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="Write the manifest as newline-delimited JSON, for piping to manifest_to_synapse.py --input_format ndjson -. Rows of files named in --name_registry are written a batch per GUID as it finishes; new files are named and written last.")
+    parser.add_argument("--join_partitions", type=int, default=None,
+                        help="With --stream and '--source submissions', merge samples with tissues and subjects through this many partitions spilled to disk, writing a batch per partition.")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace event timeline of the run to this file.")
+    parser.add_argument("--hedge_percentile", type=float, default=95,
+                        help="Send a duplicate NDA request once a request is slower than this percentile of recent ones (0 for never). [default: %(default)s]")
+    parser.add_argument("--circuit_failures", type=int, default=5,
+                        help="Consecutive failures of an NDA endpoint before its requests fail fast. [default: %(default)s]")
+    parser.add_argument("--circuit_reset", type=float, default=30,
+                        help="Seconds to fail fast before retrying a failing NDA endpoint. [default: %(default)s]")
 
     args = parser.parse_args()
 
+    atexit.register(ndasynapse.client.log_flight_stats)
+
+    if args.trace:
+        ndasynapse.trace.enable()
+        atexit.register(ndasynapse.trace.export_chrome_trace, args.trace)
+
+    ndasynapse.nda.configure_session(hedge_percentile=args.hedge_percentile or None,
+                                     failure_threshold=args.circuit_failures,
+                                     reset_timeout=args.circuit_reset)
+
+    if args.stream and (args.shard or args.merge_shards):
+        parser.error("--stream works without --shard or --merge_shards.")
+
+    if args.join_partitions and not (args.stream and args.source == "submissions"):
+        parser.error("--join_partitions works with --stream and '--source submissions'.")
+
     config = json.load(open(args.config))
     auth = ndasynapse.nda.authenticate(config)
     logger.info(auth)
@@ -62,100 +293,44 @@ def main():
     # Using the concatenated manifests as the master list of files to store, create file handles and entities in Synapse.
     # Use the metadata table to get the appropriate tissue/subject/sample annotations to set on each File entity.
 
-    samples = pandas.DataFrame()
-    subjects = pandas.DataFrame()
-    btb = pandas.DataFrame()
-    
-    for guid in args.guids:
-        samples_guid = ndasynapse.nda.get_samples(auth, guid=guid)
-        samples_guid = ndasynapse.nda.get_sample_data_files(samples_guid)
-
-        logging.debug("Got samples for %s" % guid)
-        
-        # exclude some experiments
-        samples_guid = ndasynapse.nda.process_samples(samples_guid)
-
-        # TEMPORARY FIXES - NEED TO BE ADJUSTED AT NDA
-        try:
-            samples_guid.loc[samples_guid['site'] == 'Salk', 'site'] = 'U01MH106882'
-        except KeyError:
-            pass
-        
-        subjects_guid = ndasynapse.nda.get_subjects(auth, guid)
-        subjects_guid = ndasynapse.nda.subjects_to_df(subjects_guid)
-        subjects_guid = ndasynapse.nda.process_subjects(subjects_guid,
-                                                        EXCLUDE_GENOMICS_SUBJECTS)
-        
-        btb_guid = ndasynapse.nda.get_tissues(auth, guid)
-        btb_guid = ndasynapse.nda.tissues_to_df(btb_guid)
-        btb_guid = ndasynapse.nda.process_tissues(btb_guid)
-
-        samples = samples.append(samples_guid)
-        subjects = subjects.append(subjects_guid)
-        btb = btb.append(btb_guid)
+    if args.get_experiments and not args.shard:
+        prefetcher = ndasynapse.nda.ExperimentPrefetcher(auth, max_workers=args.experiment_workers)
+        atexit.register(prefetcher.shutdown)
+    else:
+        prefetcher = None
 
-    btb_subjects = ndasynapse.nda.merge_tissues_subjects(btb, subjects)    
-    metadata = ndasynapse.nda.merge_tissues_samples(btb_subjects, samples)
+    if args.stream:
+        stream_manifest(auth, config, args, sys.stdout, prefetcher=prefetcher)
+        return
+
+    if args.merge_shards:
+        metadata = pandas.concat([pandas.read_csv(x, dtype=str) for x in args.merge_shards],
+                                 ignore_index=True)
+        metadata = metadata.drop_duplicates()
+        logger.info("Merged %s shards, %s records." % (len(args.merge_shards), metadata.shape[0]))
+    else:
+        metadata = get_metadata(auth, config, args, prefetcher=prefetcher)
 
     if args.dataset_ids:
-        metadata = metadata[metadata.datasetid.isin(args.dataset_ids)]
+        metadata = ndasynapse.nda.filter_dataset_ids(metadata, args.dataset_ids)
         logger.info("Filtered for requested dataset IDs, %s records remaining." % metadata.shape[0])
 
-    if args.get_experiments:
-        if args.verbose:
-            logger.info("Getting experiments")
-
-        experiment_ids = metadata.experiment_id.drop_duplicates().tolist()
-        logger.info("Experiments to get: %s" % (experiment_ids,))
-
-        if experiment_ids:
-            expts = ndasynapse.nda.get_experiments(auth,
-                                                   experiment_ids,
-                                                   verbose=args.verbose)
+    if args.shard:
+        logger.info("Writing metadata for shard %s." % (args.shard, ))
+        metadata.to_csv(sys.stdout, index=False, encoding='utf-8')
+        return
 
-            expts = ndasynapse.nda.process_experiments(expts)
-            expts = expts.drop_duplicates()
-
-            logger.info("Experiments processed: %s" % (expts,))
-            metadata = metadata.merge(expts, how="left", left_on="experiment_id",
-                                      right_on="experiment_id")
-            logger.info("Retrieved experiments.")
-        else:
-            logger.info("No experiments retrieved")
+    if args.get_experiments:
+        metadata = ndasynapse.nda.merge_experiments(auth, metadata, verbose=args.verbose,
+                                                    prefetcher=prefetcher)
     
     # Look for duplicates based on base filename
     # We are putting all files into a single folder, so can't conflict on name
     # Decided to rename both the entity name and the downloadAs
-    metadata['basename'] = metadata.data_file.apply(os.path.basename)
-
-    (good, bad) = ndasynapse.nda.find_duplicate_filenames(metadata)
-
-    if bad.shape[0] > 0:
-        syn = synapseclient.login(silent=True)
-
-        try:
-            namespace = uuid.UUID(ndasynapse.synapse.get_namespace(syn,
-                                                                   PROJECT_ID))
-            
-            bad_uuids = bad.data_file.apply(lambda x: uuid.uuid3(namespace,
-                                                                 x))
-            bad_slugs = bad_uuids.apply(lambda x: ndasynapse.synapse.uuid2slug(x))
-            bad_slugs.name = 'slug'
-            
-            bad_filename_info = pandas.concat([bad_slugs, bad['basename']], axis=1)
-            fileNameOverride = bad_filename_info.apply(lambda x: '_'.join(map(str, x)), axis=1)
-            
-            bad['fileName'] = fileNameOverride
-            good['fileName'] = good['basename']
-            
-            metadata = pandas.concat([good, bad])
-        except KeyError:
-            logging.info("Couldn't get namespace. Not processing bad files")
-            metadata = good
-    else:
-        metadata = good
-
-    metadata.drop('basename', inplace=True, axis=1)
+    resolver = ndasynapse.resolver.FilenameResolver(ndasynapse.synapse.PROJECT_ID,
+                                                    registry_path=args.name_registry)
+    metadata = resolver.resolve(metadata)
+    resolver.save()
 
     metadata['consortium'] = "BSMN"
 
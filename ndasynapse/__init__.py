@@ -1,2 +1,15 @@
 from . import nda
 from . import synapse
+from . import cache
+from . import resolver
+from . import journal
+from . import s3
+from . import trace
+from . import index
+from . import shard
+from . import service
+from . import client
+from . import stream
+from . import pipeline
+from . import feed
+from . import join
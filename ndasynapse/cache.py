@@ -0,0 +1,52 @@
+"""Local cache files shared across ndasynapse runs.
+
+"""
+
+import os
+import json
+import tempfile
+
+CACHE_DIR = os.environ.get('NDASYNAPSE_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.ndasynapse'))
+
+
+def cache_path(name, cache_dir=None):
+    """Get the path to a file in the cache directory, creating the directory if needed."""
+
+    cache_dir = cache_dir or CACHE_DIR
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    return os.path.join(cache_dir, name)
+
+
+def atomic_write(path, write):
+    """Write a file by calling `write` with a file object, then renaming it into place.
+
+    Readers never see a partially written file.
+
+    """
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    atomic_write(path, lambda f: json.dump(data, f, indent=2, sort_keys=True))
@@ -0,0 +1,330 @@
+"""Hedged requests and circuit breaking for HTTP APIs.
+
+A `HedgedSession` wraps a `requests.Session`. Requests to an endpoint are
+timed, and once a request has taken longer than a percentile of that
+endpoint's recent latencies, a duplicate request is sent and the first
+response to arrive is used. Only idempotent GETs should be hedged.
+
+A `CircuitBreaker` counts consecutive failures (connection errors, timeouts
+and 5xx responses) per endpoint. After `failure_threshold` failures it opens
+and requests fail immediately with `CircuitOpenError` until `reset_timeout`
+seconds have passed, when one trial request is let through.
+
+Endpoints are URL paths with the segments containing digits (ids, GUIDs)
+replaced, e.g. `/api/guid/*/data`.
+
+A `SingleFlight` coalesces concurrent calls for the same resource: the first
+caller makes the request and callers arriving while it is in flight wait for
+and share its result.
+
+"""
+
+import re
+import time
+import logging
+import functools
+import threading
+import collections
+import concurrent.futures
+
+import requests
+
+from . import trace
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Seconds to connect and to wait between bytes of a response, unless a request sets its own
+DEFAULT_TIMEOUT = (10, 300)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of sending a request to an endpoint that is failing."""
+    pass
+
+
+def endpoint_key(url):
+    parsed = urlparse(url)
+    path = "/".join("*" if re.search(r"\d", x) else x for x in parsed.path.split("/"))
+
+    return "%s%s" % (parsed.netloc, path)
+
+
+def is_failure(response):
+    return response.status_code >= 500
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = collections.defaultdict(int)
+        self.opened_at = {}
+        self.lock = threading.Lock()
+
+    def before_request(self, endpoint):
+        """Raise `CircuitOpenError` if the endpoint's circuit is open."""
+
+        with self.lock:
+            opened_at = self.opened_at.get(endpoint)
+
+            if opened_at is None:
+                return
+
+            if time.time() - opened_at < self.reset_timeout:
+                raise CircuitOpenError("Circuit open for %s after %s failures." % (endpoint,
+                                                                                   self.failures[endpoint]))
+
+            # Half open: let this request through as a trial and hold off others
+            self.opened_at[endpoint] = time.time()
+
+    def record_success(self, endpoint):
+        with self.lock:
+            self.failures.pop(endpoint, None)
+            self.opened_at.pop(endpoint, None)
+
+    def record_failure(self, endpoint):
+        with self.lock:
+            self.failures[endpoint] += 1
+
+            if self.failures[endpoint] >= self.failure_threshold:
+                if endpoint not in self.opened_at:
+                    logger.warning("Opening circuit for %s." % (endpoint, ))
+                self.opened_at[endpoint] = time.time()
+
+
+class LatencyTracker:
+    """Recent request latencies per endpoint."""
+
+    def __init__(self, window=200):
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+
+    def percentile(self, endpoint, percentile, min_samples):
+        with self.lock:
+            latencies = sorted(self.latencies[endpoint])
+
+        if len(latencies) < min_samples:
+            return None
+
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+
+class HedgedSession:
+
+    def __init__(self, session=None, hedge_percentile=95, min_samples=20, breaker=None, max_workers=64,
+                 timeout=DEFAULT_TIMEOUT):
+        """Send GETs through `session`, hedging after the `hedge_percentile` latency of an endpoint.
+
+        Hedging starts once an endpoint has `min_samples` timed requests. Set
+        `hedge_percentile` to None to turn hedging off. `timeout` is the
+        (connect, read) timeout of requests that don't set their own.
+
+        Close the session, or use it as a context manager, to shut down the
+        threads hedged requests run on.
+
+        """
+
+        self.session = session or requests.Session()
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = LatencyTracker()
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down the hedging threads without waiting for requests in flight, and close the session."""
+
+        try:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:
+            # cancel_futures is new in Python 3.9
+            self.executor.shutdown(wait=False)
+
+        self.session.close()
+
+    def _timed_get(self, url, kwargs):
+        start = time.time()
+        response = self.session.get(url, **kwargs)
+        return response, time.time() - start
+
+    def _hedge_delay(self, endpoint):
+        if self.hedge_percentile is None:
+            return None
+
+        return self.latencies.percentile(endpoint, self.hedge_percentile, self.min_samples)
+
+    def get(self, url, hedge=True, **kwargs):
+        endpoint = endpoint_key(url)
+        self.breaker.before_request(endpoint)
+
+        kwargs.setdefault('timeout', self.timeout)
+        delay = self._hedge_delay(endpoint) if hedge and not kwargs.get('stream') else None
+
+        try:
+            if delay is None:
+                response, latency = self._timed_get(url, kwargs)
+            else:
+                response, latency = self._hedged_get(url, kwargs, endpoint, delay)
+        except (requests.ConnectionError, requests.Timeout):
+            self.breaker.record_failure(endpoint)
+            raise
+
+        if is_failure(response):
+            self.breaker.record_failure(endpoint)
+        else:
+            self.breaker.record_success(endpoint)
+            self.latencies.record(endpoint, latency)
+
+        return response
+
+    def _hedged_get(self, url, kwargs, endpoint, delay):
+        """Get a response and the time the caller waited for it, from the first request to succeed."""
+
+        start = time.time()
+        primary = self.executor.submit(self._timed_get, url, kwargs)
+        done, _ = concurrent.futures.wait([primary], timeout=delay)
+
+        if done:
+            return primary.result()
+
+        self.hedges += 1
+        logger.debug("Hedging request to %s after %.2fs" % (url, delay))
+
+        with trace.span("client.hedge", url=url, delay=delay):
+            hedged = self.executor.submit(self._timed_get, url, kwargs)
+            pending = set([primary, hedged])
+
+            while pending:
+                done, pending = concurrent.futures.wait(pending,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    # Use the first successful response; if both fail, raise the last error
+                    if future.exception() is None or not pending:
+                        if future is hedged and future.exception() is None:
+                            self.hedges_won += 1
+
+                        # Release the connection of the losing request once it finishes
+                        for loser in pending:
+                            loser.add_done_callback(_close_response)
+
+                        response, _ = future.result()
+
+                        # Include the hedge delay, which the caller waited through too
+                        return response, time.time() - start
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result()[0].close()
+
+
+# All single flight groups, for reporting
+_flights = []
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _key(value):
+    """Get the part of a call key for an argument, using the identity of unhashable ones like auth objects."""
+
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return (type(value).__name__, id(value))
+
+
+class SingleFlight:
+
+    def __init__(self, name):
+        """A group of calls coalesced by key, reported under `name`."""
+
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        _flights.append(self)
+
+    def do(self, key, func, *args, **kwargs):
+        """Call `func`, unless a call with the same `key` is in flight, then wait for its result."""
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = _Call()
+                self.stats['requests'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def coalesce(self, func):
+        """Decorator to coalesce concurrent calls of a function with the same (hashable) arguments."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__name__, tuple(map(_key, args)),
+                   tuple((name, _key(value)) for (name, value) in sorted(kwargs.items())))
+
+            return self.do(key, func, *args, **kwargs)
+
+        return wrapper
+
+
+def flight_stats():
+    """Get the request and coalesced call counts of each single flight group."""
+
+    return {flight.name: dict(flight.stats) for flight in _flights}
+
+
+def log_flight_stats():
+    for name, stats in flight_stats().items():
+        if stats:
+            logger.info("%s: %s requests, %s coalesced calls." % (name, stats.get('requests', 0),
+                                                                   stats.get('coalesced', 0)))
@@ -0,0 +1,163 @@
+"""Incremental change feed of the submissions in NDA collections.
+
+A `SubmissionFeed` keeps, for each collection, the status and modified dates
+of the submissions it has seen and a watermark of the newest submission
+modified date. Each run lists the submissions of a collection and only
+requests the files of submissions that are new, changed status, or were
+modified after the watermark. The state is kept in a JSON file in the cache
+directory and only advances when the caller commits a change set.
+
+"""
+
+import logging
+import concurrent.futures
+
+import pandas
+
+from . import nda
+from . import cache
+from . import trace
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+STATE_FILE = 'submission_watermarks.json'
+
+CHANGE_NEW = 'new'
+CHANGE_MODIFIED = 'modified'
+CHANGE_REMOVED = 'removed'
+
+CHANGE_COLUMNS = ['collectionid', 'submission_id', 'submission_status', 'change',
+                  'id', 'file_type', 'file_remote_path', 'status', 'md5sum', 'size',
+                  'created_date', 'modified_date']
+
+
+def _timestamp(value):
+    """Parse an NDA date to a UTC timestamp, or None."""
+
+    if value is None:
+        return None
+
+    timestamp = pandas.to_datetime(value, utc=True, errors='coerce')
+
+    return None if pandas.isnull(timestamp) else timestamp
+
+
+class SubmissionFeed:
+
+    def __init__(self, auth, path=None, cache_dir=None, max_workers=8):
+        self.auth = auth
+        self.path = path or cache.cache_path(STATE_FILE, cache_dir=cache_dir)
+        self.max_workers = max_workers
+        self.state = cache.read_json(self.path, default={})
+        self._pending = {}
+
+    def watermark(self, collection_id):
+        return self.state.get(str(collection_id), {}).get('watermark')
+
+    def _unchanged(self, seen, submission, watermark):
+        """Check from the submission listing alone if a submission is unchanged since it was seen."""
+
+        if seen is None or seen['submission_status'] != submission['submission_status']:
+            return False
+
+        modified = _timestamp(submission.get('modified_date'))
+
+        # Without a modified date in the listing, the files have to be checked
+        return modified is not None and watermark is not None and modified <= _timestamp(watermark)
+
+    def _files(self, submission_id):
+        files = nda.process_submission_files(nda.get_submission_files(self.auth, submission_id))
+        return files.reindex(columns=CHANGE_COLUMNS[4:])
+
+    @trace.traced("feed.collection_changes")
+    def collection_changes(self, collection_id):
+        """Get the changed submission files of a collection since the last commit."""
+
+        collection_id = str(collection_id)
+        previous = self.state.get(collection_id, {})
+        seen = previous.get('submissions', {})
+        watermark = previous.get('watermark')
+
+        submissions = nda.get_submissions(self.auth, collection_id)
+
+        candidates = []
+        submissions_state = {}
+
+        for submission in submissions:
+            submission_id = str(submission['submission_id'])
+            record = {'submission_status': submission['submission_status'],
+                      'modified_date': submission.get('modified_date'),
+                      'files_modified_date': seen.get(submission_id, {}).get('files_modified_date')}
+            submissions_state[submission_id] = record
+
+            if not self._unchanged(seen.get(submission_id), submission, watermark):
+                candidates.append((submission_id, record))
+
+        logger.info("Collection %s: %s submissions, checking files of %s." % (collection_id,
+                                                                                len(submissions),
+                                                                                len(candidates)))
+
+        changes = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._files, submission_id): (submission_id, record)
+                       for (submission_id, record) in candidates}
+
+            for future in concurrent.futures.as_completed(futures):
+                submission_id, record = futures[future]
+                files = future.result()
+
+                files_modified = pandas.to_datetime(files.modified_date, utc=True, errors='coerce').max()
+                files_modified = None if pandas.isnull(files_modified) else files_modified
+                record['files_modified_date'] = files_modified.isoformat() if files_modified is not None else None
+
+                previous_record = seen.get(submission_id)
+
+                if previous_record is None:
+                    change = CHANGE_NEW
+                elif (previous_record['submission_status'] != record['submission_status'] or
+                      previous_record.get('files_modified_date') != record['files_modified_date']):
+                    change = CHANGE_MODIFIED
+                else:
+                    continue
+
+                changes.append(files.assign(collectionid=collection_id, submission_id=submission_id,
+                                            submission_status=record['submission_status'],
+                                            change=change))
+
+        for submission_id in set(seen).difference(submissions_state):
+            changes.append(pandas.DataFrame({'collectionid': [collection_id],
+                                             'submission_id': [submission_id],
+                                             'submission_status': [seen[submission_id]['submission_status']],
+                                             'change': [CHANGE_REMOVED]}))
+
+        modified_dates = [_timestamp(x['modified_date']) for x in submissions_state.values()]
+        modified_dates = [x for x in modified_dates if x is not None]
+
+        self._pending[collection_id] = {'watermark': max(modified_dates).isoformat() if modified_dates else watermark,
+                                        'submissions': submissions_state}
+
+        if not changes:
+            return pandas.DataFrame(columns=CHANGE_COLUMNS)
+
+        return pandas.concat(changes, ignore_index=True).reindex(columns=CHANGE_COLUMNS)
+
+    def changes(self, collection_ids):
+        """Get the changed submission files of collections since the last commit.
+
+        Returns a data frame with a row per file of each new or modified
+        submission and a row per removed submission, with the kind of change
+        in the `change` column.
+
+        """
+
+        return pandas.concat([self.collection_changes(collection_id) for collection_id in collection_ids],
+                             ignore_index=True)
+
+    def commit(self):
+        """Advance the watermarks past the changes returned so far and save them."""
+
+        self.state.update(self._pending)
+        self._pending = {}
+        cache.write_json(self.path, self.state)
@@ -0,0 +1,120 @@
+"""Local indexes of Synapse file views.
+
+A `FileViewIndex` keeps selected columns of a file view in a CSV file in the
+cache directory. Refreshing only queries rows modified since the newest row
+already in the index. Rows deleted from the view are only dropped by a full
+refresh.
+
+"""
+
+import logging
+
+import pandas
+
+from . import cache
+from . import trace
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def _modified_on_ms(column):
+    """Get `modifiedOn` values as milliseconds since the epoch."""
+
+    if pandas.api.types.is_datetime64_any_dtype(column):
+        return column.astype('int64') // 10 ** 6
+
+    return pandas.to_numeric(column)
+
+
+class FileViewIndex:
+
+    def __init__(self, syn, file_view_id, columns, cache_dir=None):
+        self.syn = syn
+        self.file_view_id = file_view_id
+        self.columns = [col for col in columns if col not in ('id', 'modifiedOn')]
+        self.path = cache.cache_path("%s.%s.csv" % (file_view_id, "-".join(self.columns)),
+                                     cache_dir=cache_dir)
+
+        try:
+            self.data = pandas.read_csv(self.path, dtype=str)
+            self.data['modifiedOn'] = pandas.to_numeric(self.data['modifiedOn'])
+        except (IOError, OSError):
+            self.data = None
+
+    def query(self, where=None):
+        query = "select id,modifiedOn,%s from %s" % (",".join(self.columns), self.file_view_id)
+
+        if where:
+            query += " where %s" % (where, )
+
+        df = self.syn.tableQuery(query).asDataFrame()
+        df = df[['id', 'modifiedOn'] + self.columns].reset_index(drop=True)
+        df['modifiedOn'] = _modified_on_ms(df['modifiedOn'])
+
+        return df
+
+    @trace.traced("index.refresh")
+    def refresh(self, full=False):
+        """Bring the index up to date with the file view and save it."""
+
+        if full or self.data is None:
+            self.data = self.query()
+            logger.info("Loaded %s rows from %s." % (self.data.shape[0], self.file_view_id))
+        else:
+            since = int(self.data.modifiedOn.max()) if self.data.shape[0] > 0 else 0
+            changed = self.query(where="modifiedOn >= %s" % (since, ))
+            logger.info("Loaded %s rows modified in %s." % (changed.shape[0], self.file_view_id))
+
+            self.data = pandas.concat([self.data, changed], ignore_index=True)
+            self.data = self.data.drop_duplicates('id', keep='last').reset_index(drop=True)
+
+        self.save()
+
+        return self.data
+
+    def save(self):
+        cache.atomic_write(self.path, lambda f: self.data.to_csv(f, index=False))
+
+
+class Md5Index(FileViewIndex):
+    """Index of a file view from file md5 to entity id, version and file handle id.
+
+    Lookups return a list of dictionaries shaped like the results of the
+    `/entity/md5/{md5}` REST call, with the file handle id added.
+
+    """
+
+    def __init__(self, syn, file_view_id, md5_column='dataFileMD5Hex', cache_dir=None):
+        self.md5_column = md5_column
+        self._lookup = None
+
+        super(Md5Index, self).__init__(syn, file_view_id,
+                                       columns=[md5_column, 'parentId', 'currentVersion',
+                                                'dataFileHandleId'],
+                                       cache_dir=cache_dir)
+
+    def refresh(self, full=False):
+        data = super(Md5Index, self).refresh(full=full)
+        self._lookup = None
+
+        return data
+
+    def lookup(self, md5):
+        if self.data is None:
+            self.refresh()
+
+        if self._lookup is None:
+            self._lookup = {}
+            data = self.data.dropna(subset=[self.md5_column])
+
+            for (entity_id, entity_md5, parent_id, version, file_handle_id) in zip(data.id,
+                                                                                  data[self.md5_column],
+                                                                                  data.parentId,
+                                                                                  data.currentVersion,
+                                                                                  data.dataFileHandleId):
+                self._lookup.setdefault(entity_md5, []).append(
+                    dict(id=entity_id, versionNumber=int(float(version)), parentId=parent_id,
+                         dataFileHandleId=str(file_handle_id).split('.')[0]))
+
+        return self._lookup.get(md5, [])
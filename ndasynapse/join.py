@@ -0,0 +1,173 @@
+"""Out-of-core joins of data frames too large to merge in memory.
+
+Both sides of a join are hash partitioned on their join keys and spilled to
+temporary files, as a sequence of pickled data frame chunks per partition.
+Keys are converted to strings first, with numbers written the same way
+whatever their dtype (1 and 1.0 are both '1'), so rows with equal keys land
+in the same partition on both sides. Joining each pair of partitions on its
+own and concatenating the results gives the same rows as one `merge`, in a
+different order. Only one pair of partitions is in memory at a time.
+
+"""
+
+import os
+import shutil
+import pickle
+import logging
+import tempfile
+
+import pandas
+
+from . import trace
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def _chunks(data, chunksize):
+    """Iterate over a data frame in chunks, or over an iterable of data frames as is."""
+
+    if isinstance(data, pandas.DataFrame):
+        for start in range(0, max(data.shape[0], 1), chunksize):
+            yield data.iloc[start:start + chunksize]
+    else:
+        for chunk in data:
+            yield chunk
+
+
+def _key_columns(count):
+    return ["_join_key_%s" % (n, ) for n in range(count)]
+
+
+def normalize_key(column):
+    """Convert a join key column to strings, with None for nulls.
+
+    Numbers are written without a trailing `.0` when they are whole, so
+    integer and float keys that `merge` treats as equal become equal strings.
+
+    """
+
+    if pandas.api.types.is_bool_dtype(column) or not pandas.api.types.is_numeric_dtype(column):
+        keys = column.astype(object).map(str)
+    else:
+        keys = column.map(lambda x: ("%d" % x) if float(x).is_integer() else repr(float(x)))
+
+    return keys.astype(object).where(column.notnull(), None)
+
+
+def partition_of(df, on, partitions):
+    """Get the partition of each row of a data frame from a hash of its normalized `on` columns."""
+
+    keys = pandas.DataFrame({n: normalize_key(df[col]) for (n, col) in enumerate(on)})
+
+    return pandas.util.hash_pandas_object(keys, index=False).values % partitions
+
+
+class Partitioner:
+    """Spill data frame chunks to `partitions` files in a directory, by a hash of their `on` columns.
+
+    The normalized keys are added to the spilled chunks as `_join_key_<n>` columns.
+
+    """
+
+    def __init__(self, directory, name, on, partitions):
+        self.on = on
+        self.partitions = partitions
+        self.paths = [os.path.join(directory, "%s-%04d.pickle" % (name, n)) for n in range(partitions)]
+        self.rows = 0
+        self.columns = None
+
+    def write(self, df):
+        df = df.assign(**{key: normalize_key(df[col]) for (key, col) in zip(_key_columns(len(self.on)),
+                                                                             self.on)})
+
+        if self.columns is None:
+            self.columns = df.columns
+
+        if df.shape[0] == 0:
+            return
+
+        self.rows += df.shape[0]
+        partition = partition_of(df, _key_columns(len(self.on)), self.partitions)
+
+        for n, part in df.groupby(partition, sort=False):
+            with open(self.paths[n], 'ab') as f:
+                pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read(self, n):
+        """Read partition `n` back as a single data frame."""
+
+        chunks = []
+
+        try:
+            with open(self.paths[n], 'rb') as f:
+                while True:
+                    try:
+                        chunks.append(pickle.load(f))
+                    except EOFError:
+                        break
+        except (IOError, OSError):
+            pass
+
+        if not chunks:
+            return pandas.DataFrame(columns=self.columns)
+
+        return pandas.concat(chunks)
+
+
+def hash_join(left, right, left_on, right_on=None, how='inner', partitions=64, chunksize=100000,
+              tmp_dir=None):
+    """Join two data frames, or iterables of data frame chunks, through partitions spilled to disk.
+
+    Yields the joined rows of each partition as a data frame. `how` is passed
+    to `pandas.merge` and can be 'inner' or 'left'. Keys are compared after
+    `normalize_key`, so keys of different dtypes match when their values are
+    equal. Temporary files are made in `tmp_dir` and removed when the
+    generator is finished or closed.
+
+    """
+
+    if how not in ('inner', 'left'):
+        raise ValueError("Only inner and left joins can be partitioned, not %s." % (how, ))
+
+    if isinstance(left_on, str):
+        left_on = [left_on]
+
+    right_on = right_on or left_on
+
+    if isinstance(right_on, str):
+        right_on = [right_on]
+
+    keys = _key_columns(len(left_on))
+
+    # As with `merge`, a key with the same name on both sides is only kept from the left
+    shared_keys = [right for (left, right) in zip(left_on, right_on) if left == right]
+    directory = tempfile.mkdtemp(prefix='ndasynapse-join-', dir=tmp_dir)
+
+    try:
+        left_parts = Partitioner(directory, 'left', left_on, partitions)
+        right_parts = Partitioner(directory, 'right', right_on, partitions)
+
+        with trace.span("join.partition"):
+            for chunk in _chunks(left, chunksize):
+                left_parts.write(chunk)
+
+            for chunk in _chunks(right, chunksize):
+                right_parts.write(chunk)
+
+        logger.info("Joining %s and %s rows in %s partitions." % (left_parts.rows, right_parts.rows,
+                                                                 partitions))
+
+        for n in range(partitions):
+            left_part = left_parts.read(n)
+
+            if left_part.shape[0] == 0:
+                continue
+
+            with trace.span("join.merge_partition", partition=n):
+                right_part = right_parts.read(n).drop(shared_keys, axis=1)
+                joined = left_part.merge(right_part, how=how, on=keys).drop(keys, axis=1)
+
+            yield joined
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,87 @@
+"""Append-only journal of file handles and entities created while storing.
+
+Each line is a JSON record, flushed and synced to disk as soon as it is
+written, so a crash loses at most the row being stored. A rerun with the
+same journal skips rows whose entities were stored and reuses file handles
+that were created but not yet attached to an entity.
+
+"""
+
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+FILE_HANDLE = 'filehandle'
+ENTITY = 'entity'
+
+
+class StoreJournal:
+
+    def __init__(self, path):
+        self.path = path
+        self.file_handles = {}
+        self.entities = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            self._load()
+
+        self._file = open(path, 'a')
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partial line from a crash while writing
+                    logger.warning("Skipping incomplete journal record: %s" % (line, ))
+                    continue
+
+                if record['type'] == FILE_HANDLE:
+                    self.file_handles[record['key']] = record['dataFileHandleId']
+                elif record['type'] == ENTITY:
+                    self.entities[record['key']] = (record['id'], record['versionNumber'])
+
+        logger.info("Journal %s has %s stored entities and %s file handles." % (self.path,
+                                                                                len(self.entities),
+                                                                                len(self.file_handles)))
+
+    def _append(self, record):
+        with self.lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def record_file_handle(self, key, file_handle_id):
+        self.file_handles[key] = file_handle_id
+        self._append(dict(type=FILE_HANDLE, key=key, dataFileHandleId=file_handle_id))
+
+    def record_entity(self, key, entity_id, version_number):
+        self.entities[key] = (entity_id, version_number)
+        self._append(dict(type=ENTITY, key=key, id=entity_id, versionNumber=version_number))
+
+    def is_complete(self, key):
+        return key in self.entities
+
+    def file_handle(self, key):
+        """Get the id of a file handle already created for a row, or None."""
+
+        return self.file_handles.get(key)
+
+    def pending(self, synapse_manifest, key_column='data_file'):
+        """Get the rows of a manifest that have not been stored yet."""
+
+        complete = synapse_manifest[key_column].isin(list(self.entities.keys()))
+
+        if complete.any():
+            logger.info("Skipping %s rows already stored." % (complete.sum(), ))
+
+        return synapse_manifest[~complete].copy()
+
+    def close(self):
+        self._file.close()
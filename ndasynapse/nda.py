@@ -7,12 +7,20 @@ import os
 import json
 import logging
 import sys
+import time
+import pickle
+import threading
+import concurrent.futures
 
 import requests
 import pandas
 import boto3
 from deprecated import deprecated
 
+from . import trace
+from . import client
+from . import join
+
 pandas.options.display.max_rows = None
 pandas.options.display.max_columns = None
 pandas.options.display.max_colwidth = 1000
@@ -71,6 +79,31 @@ APPLICATION_SUBTYPE_REPLACEMENTS = {"Whole genome sequencing": "wholeGenomeSeq",
 
 MANIFEST_COLUMNS = ['filename', 'md5', 'size']
 
+# This is an old genomics subject
+EXCLUDE_GENOMICS_SUBJECTS = ('92027', )
+
+# Shared so that connections to NDA are reused across requests. GETs are
+# hedged against slow responses and fail fast while an endpoint is down.
+session = client.HedgedSession(requests.Session())
+
+# Concurrent requests for the same NDA resource share one response
+flights = client.SingleFlight("nda")
+
+
+def configure_session(hedge_percentile=95, failure_threshold=5, reset_timeout=30):
+    """Set the hedging percentile (None for no hedging) and circuit breaker of NDA requests."""
+
+    session.hedge_percentile = hedge_percentile
+    session.breaker = client.CircuitBreaker(failure_threshold=failure_threshold,
+                                            reset_timeout=reset_timeout)
+
+SAMPLE_STRUCTURE = 'genomics_sample03'
+SUBJECT_STRUCTURE = 'genomics_subject02'
+TISSUE_STRUCTURE = 'nichd_btb02'
+
+SUBMISSION_COLUMNS = ['collectionid', 'collectiontitle', 'submission_id',
+                      'submission_status', 'dataset_title']
+
 def authenticate(config):
     # # Credential configuration for NDA
     
@@ -81,10 +114,11 @@ def authenticate(config):
     return auth
 
 
+@trace.traced()
 def get_samples(auth, guid):
     """Use the NDA api to get the `genomics_sample03` records for a GUID."""
 
-    r = requests.get("https://nda.nih.gov/api/guid/{}/data?short_name=genomics_sample03".format(guid),
+    r = session.get("https://nda.nih.gov/api/guid/{}/data?short_name=genomics_sample03".format(guid),
                      auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug("Request %s for GUID %s" % (r, guid))
@@ -94,10 +128,12 @@ def get_samples(auth, guid):
 
     return r.json()
 
+@flights.coalesce
+@trace.traced()
 def get_submissions(auth, collectionid, users_own_submissions=False):
     """Use the NDA api to get the `genomics_sample03` records for a GUID."""
 
-    r = requests.get("https://nda.nih.gov/api/submission/",
+    r = session.get("https://nda.nih.gov/api/submission/",
                      params={'usersOwnSubmissions': users_own_submissions,
                              'collectionId': collectionid},
                      auth=auth, headers={'Accept': 'application/json'})
@@ -110,6 +146,33 @@ def get_submissions(auth, collectionid, users_own_submissions=False):
 
     return r.json()
 
+def iter_submissions(auth, collectionids, users_own_submissions=False, max_workers=8):
+    """Get the submissions for many NDA collections concurrently.
+
+    Submission records are yielded as each collection's request completes,
+    so callers can start writing results before all collections are listed.
+
+    """
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_submissions, auth, collectionid,
+                                   users_own_submissions=users_own_submissions): collectionid
+                   for collectionid in collectionids}
+
+        for future in concurrent.futures.as_completed(futures):
+            submissions = future.result()
+            logger.debug("Got %s submissions for collection %s" % (len(submissions), futures[future]))
+
+            for submission in submissions:
+                yield submission
+
+def submission_record(x):
+    """Flatten a single submission from nested JSON to a dictionary."""
+
+    return dict(collectionid=x['collection']['id'], collectiontitle=x['collection']['title'],
+                submission_id=x['submission_id'], submission_status=x['submission_status'],
+                dataset_title=x['dataset_title'])
+
 def process_submissions(submission_data):
     """Process submissions from nested JSON to a data frame.
     """
@@ -117,16 +180,65 @@ def process_submissions(submission_data):
     if not isinstance(submission_data, (list,)):
         submission_data = [submission_data]
     
-    submissions =  [dict(collectionid=x['collection']['id'], collectiontitle=x['collection']['title'],
-                         submission_id=x['submission_id'], submission_status=x['submission_status'],
-                         dataset_title=x['dataset_title']) for x in submission_data]
+    submissions = [submission_record(x) for x in submission_data]
+
+    return pandas.DataFrame(submissions, columns=SUBMISSION_COLUMNS)
+
+def write_submissions(submission_data, out, output_format="csv", chunksize=1000):
+    """Write an iterable of submissions to a file object in chunks.
+
+    Only `chunksize` records are held in memory at once. The `parquet` format
+    requires `pyarrow` and a binary file object.
 
-    return pandas.DataFrame(submissions)
+    """
 
+    if output_format == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+
+        schema = pyarrow.schema([(col, pyarrow.string()) for col in SUBMISSION_COLUMNS])
+        writer = pyarrow.parquet.ParquetWriter(out, schema)
+
+        def write_chunk(records, first):
+            columns = {col: [None if x[col] is None else str(x[col]) for x in records]
+                       for col in SUBMISSION_COLUMNS}
+            writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+    elif output_format == "csv":
+        writer = None
+
+        def write_chunk(records, first):
+            pandas.DataFrame(records, columns=SUBMISSION_COLUMNS).to_csv(out, header=first,
+                                                                        index=False)
+    else:
+        raise ValueError("Unknown output format: %s" % (output_format, ))
+
+    chunk = []
+    first = True
+    count = 0
+
+    for x in submission_data:
+        chunk.append(submission_record(x))
+        if len(chunk) >= chunksize:
+            write_chunk(chunk, first)
+            count += len(chunk)
+            first = False
+            chunk = []
+
+    if chunk or first:
+        write_chunk(chunk, first)
+        count += len(chunk)
+
+    if writer is not None:
+        writer.close()
+
+    return count
+
+@flights.coalesce
+@trace.traced()
 def get_submission(auth, submissionid):
     """Use the NDA api to get the `genomics_sample03` records for a GUID."""
 
-    r = requests.get("https://nda.nih.gov/api/submission/{}".format(submissionid),
+    r = session.get("https://nda.nih.gov/api/submission/{}".format(submissionid),
                      auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug("Request %s for submission %s" % (r, submissionid))
@@ -136,10 +248,12 @@ def get_submission(auth, submissionid):
 
     return r.json()
 
+@flights.coalesce
+@trace.traced()
 def get_submission_files(auth, submissionid, submission_file_status="Complete", retrieve_files_to_upload=False):
     """Use the NDA api to get the `genomics_sample03` records for a GUID."""
 
-    r = requests.get("https://nda.nih.gov/api/submission/{}/files".format(submissionid),
+    r = session.get("https://nda.nih.gov/api/submission/{}/files".format(submissionid),
                      params={'submissionFileStatus': submission_file_status,
                              'retrieveFilesToUpload': retrieve_files_to_upload},
                      auth=auth, headers={'Accept': 'application/json'})
@@ -159,24 +273,71 @@ def process_submission_files(submission_files):
 
     return pandas.DataFrame(submission_files_processed)
 
-def get_sample_data_files(guid_data):
-    # Get data files from samples.
-    tmp = []
+@trace.traced()
+def decode_data_structure_rows(json_data, data_file_columns=False):
+    """Decode the `dataStructureRow` records of a GUID API response to a data frame.
+
+    Columns are built directly from the `dataElement` name/value pairs
+    and column names are lower cased. If `data_file_columns` is set, the
+    md5sum and size of `DATA_FILE*` elements are added as `<name>_md5sum`
+    and `<name>_size` columns, and the row's `datasetId` as `datasetid`.
+
+    """
+
+    rows = json_data['age'][0]['dataStructureRow']
+    nrows = len(rows)
+
+    columns = {}
+    lower_names = {}
 
-    for row in guid_data['age'][0]['dataStructureRow']:
-        tmp_row_dict = {}
+    def column(name):
+        try:
+            return columns[name]
+        except KeyError:
+            columns[name] = [None] * nrows
+            return columns[name]
+
+    for i, row in enumerate(rows):
         for col in row['dataElement']:
-            tmp_row_dict[col['name']] = col['value']
-            if col.get('md5sum') and col.get('size') and col['name'].startswith('DATA_FILE'):
-                tmp_row_dict["%s_md5sum" % (col['name'], )] = col['md5sum']
-                tmp_row_dict["%s_size" % (col['name'], )] = col['size']
-        tmp.append(tmp_row_dict)
+            name = col['name']
+            try:
+                lower_name = lower_names[name]
+            except KeyError:
+                lower_name = lower_names[name] = name.lower()
 
-    samples = pandas.io.json.json_normalize(tmp)
-    samples['datasetId'] = [x['datasetId'] for x in guid_data['age'][0]['dataStructureRow']]
+            column(lower_name)[i] = col['value']
+
+            if data_file_columns and col.get('md5sum') and col.get('size') and name.startswith('DATA_FILE'):
+                column("%s_md5sum" % (lower_name, ))[i] = col['md5sum']
+                column("%s_size" % (lower_name, ))[i] = col['size']
+
+    if data_file_columns:
+        columns['datasetid'] = [row['datasetId'] for row in rows]
+
+    return pandas.DataFrame(columns, index=pandas.RangeIndex(nrows))
+
+
+def get_sample_data_files(guid_data):
+    """Get data files from samples."""
+
+    return decode_data_structure_rows(guid_data, data_file_columns=True)
+
+
+def filter_dataset_ids(df, dataset_ids):
+    """Keep the rows whose `datasetid` is one of `dataset_ids`, compared as strings."""
+
+    return df[df.datasetid.astype(str).isin(set(map(str, dataset_ids)))]
 
-    return samples
 
+def has_dataset_ids(json_data, dataset_ids):
+    """Check if any row of a GUID API response is in one of `dataset_ids`."""
+
+    rows = json_data['age'][0]['dataStructureRow']
+
+    return not set(map(str, dataset_ids)).isdisjoint(str(row['datasetId']) for row in rows)
+
+
+@trace.traced()
 def process_samples(samples):
 
     colnames_lower = [x.lower() for x in samples.columns.tolist()]
@@ -184,6 +345,10 @@ def process_samples(samples):
 
     datafile_column_names = samples.filter(regex="data_file\d+$").columns.tolist()
 
+    if not datafile_column_names:
+        logger.info("No data files in the samples.")
+        return pandas.DataFrame(columns=SAMPLE_COLUMNS + ['data_file', 'fileFormat', 'md5', 'size', 'species'])
+
     samples_final = pandas.DataFrame()
 
     for col in datafile_column_names:
@@ -211,7 +376,7 @@ def process_samples(samples):
                                         inplace=True)
 
     # Remove initial slash to match what is in manifest file
-    samples_final.data_file = samples_final['data_file'].apply(lambda value: value[1:] if not pandas.isnull(value) else value)
+    samples_final.data_file = samples_final['data_file'].apply(lambda value: value[1:] if not pandas.isnull(value) and value.startswith(('/', '<')) else value)
 
     # Remove stuff that isn't part of s3 path
     samples_final.data_file = [str(x).replace("![CDATA[", "").replace("]]>", "") for x in samples_final.data_file.tolist()]
@@ -227,10 +392,21 @@ def process_samples(samples):
     return samples_final
 
 
+def fix_samples(samples):
+    # TEMPORARY FIXES - NEED TO BE ADJUSTED AT NDA
+    try:
+        samples.loc[samples['site'] == 'Salk', 'site'] = 'U01MH106882'
+    except KeyError:
+        pass
+
+    return samples
+
+
+@trace.traced()
 def get_subjects(auth, guid):
     """Use the NDA API to get the `genomics_subject02` records for this GUID."""
 
-    r = requests.get("https://nda.nih.gov/api/guid/{}/data?short_name=genomics_subject02".format(guid),
+    r = session.get("https://nda.nih.gov/api/guid/{}/data?short_name=genomics_subject02".format(guid),
                      auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug("Request %s for GUID %s" % (r, guid))
@@ -242,20 +418,10 @@ def get_subjects(auth, guid):
 
 def subjects_to_df(json_data):
 
-    tmp = []
-
-    for row in json_data['age'][0]['dataStructureRow']:
-        foo = {col['name']: col['value'] for col in row['dataElement']}
-        tmp.append(foo)
-
-    df = pandas.io.json.json_normalize(tmp)
-
-    colnames_lower = map(lambda x: x.lower(), df.columns.tolist())
-    df.columns = colnames_lower
-
-    return df
+    return decode_data_structure_rows(json_data)
 
 
+@trace.traced()
 def process_subjects(df, exclude_genomics_subjects=[]):
     # For some reason there are different ids for this that aren't usable
     # anywhere, so dropping them for now
@@ -277,10 +443,11 @@ def process_subjects(df, exclude_genomics_subjects=[]):
     return df
 
 
+@trace.traced()
 def get_tissues(auth, guid):
     """Use the NDA api to get the `ncihd_btb02` records for this GUID."""
 
-    r = requests.get("https://nda.nih.gov/api/guid/{}/data".format(guid),
+    r = session.get("https://nda.nih.gov/api/guid/{}/data".format(guid),
                      params={"short_name": "nichd_btb02"},
                      auth=auth, headers={'Accept': 'application/json'})
 
@@ -292,17 +459,11 @@ def get_tissues(auth, guid):
     return r.json()
 
 def tissues_to_df(json_data):
-    tmp = []
-    
-    for row in json_data['age'][0]['dataStructureRow']:
-        foo = {col['name']: col['value'] for col in row['dataElement']}
-        tmp.append(foo)
 
-    df = pandas.io.json.json_normalize(tmp)
-
-    return df
+    return decode_data_structure_rows(json_data)
 
 
+@trace.traced()
 def process_tissues(df):
     colnames_lower = map(lambda x: x.lower(), df.columns.tolist())
     df.columns = colnames_lower
@@ -317,6 +478,141 @@ def process_tissues(df):
     return df
 
 
+@flights.coalesce
+@trace.traced()
+def get_guid_structure(auth, guid, short_name):
+    """Use the NDA API to get the records of a structure for a GUID as the raw JSON response body."""
+
+    with trace.span("nda.request", guid=guid, short_name=short_name):
+        r = session.get("https://nda.nih.gov/api/guid/{}/data".format(guid),
+                         params={"short_name": short_name},
+                         auth=auth, headers={'Accept': 'application/json'})
+
+    logger.debug("Request %s for GUID %s" % (r, guid))
+
+    if r.status_code != 200:
+        raise requests.HTTPError("{} - {} - {}".format(r.status_code, r.url, r.text))
+
+    return r.content
+
+
+def get_guid_data(auth, guid, trace_parent=None, dataset_ids=None):
+    """Get the raw samples, subjects and tissues responses for a GUID.
+
+    If `dataset_ids` are given and none of the GUID's samples are in them, the
+    subjects and tissues aren't requested and None is returned.
+
+    """
+
+    with trace.span("nda.get_guid_data", parent=trace_parent, guid=guid):
+        guid_data = {SAMPLE_STRUCTURE: get_guid_structure(auth, guid, SAMPLE_STRUCTURE)}
+
+        if dataset_ids is not None and not has_dataset_ids(json.loads(guid_data[SAMPLE_STRUCTURE]),
+                                                           dataset_ids):
+            logger.debug("No samples in the requested datasets for %s" % guid)
+            return None
+
+        for short_name in (SUBJECT_STRUCTURE, TISSUE_STRUCTURE):
+            guid_data[short_name] = get_guid_structure(auth, guid, short_name)
+
+        return guid_data
+
+
+@trace.traced()
+def process_guid_data(guid_data, exclude_genomics_subjects=(), dataset_ids=None):
+    """Decode and process the raw responses from `get_guid_data`.
+
+    Returns a tuple of the processed samples, subjects and tissues data
+    frames. If `dataset_ids` are given, samples in other datasets are dropped
+    before processing.
+
+    """
+
+    samples = get_sample_data_files(json.loads(guid_data[SAMPLE_STRUCTURE]))
+
+    if dataset_ids is not None:
+        samples = filter_dataset_ids(samples, dataset_ids)
+
+    samples = process_samples(samples)
+
+    subjects = subjects_to_df(json.loads(guid_data[SUBJECT_STRUCTURE]))
+    subjects = process_subjects(subjects, exclude_genomics_subjects)
+
+    tissues = tissues_to_df(json.loads(guid_data[TISSUE_STRUCTURE]))
+    tissues = process_tissues(tissues)
+
+    return samples, subjects, tissues
+
+
+def process_guid_data_pickled(guid_data, exclude_genomics_subjects=(), dataset_ids=None):
+    """Run `process_guid_data` in a worker process, returning its data frames pickled to bytes.
+
+    Use `pickle.loads` to get the data frames back.
+
+    """
+
+    return pickle.dumps(process_guid_data(guid_data, exclude_genomics_subjects, dataset_ids),
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def iter_guid_data(auth, guids, max_workers=1, processes=0, exclude_genomics_subjects=(),
+                   dataset_ids=None):
+    """Get and process the samples, subjects and tissues for many GUIDs.
+
+    Requests run on a pool of `max_workers` threads. If `processes` is set, decoding
+    and processing run on a pool of that many worker processes, which are sent the
+    raw response bodies; otherwise they run in this process.
+
+    Yields tuples of GUID and samples, subjects and tissues data frames as each
+    GUID finishes. If `dataset_ids` are given, only samples in those datasets are
+    kept, and GUIDs without any are yielded with None for all three data
+    frames, without requesting their subjects and tissues.
+
+    """
+
+    process_executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes) if processes else None
+    parent = trace.current_span()
+
+    def processed(future):
+        guid, start = processing.pop(future)
+        trace.add_span("nda.process_guid_data", start, time.time(), parent=parent, guid=guid)
+        samples, subjects, tissues = pickle.loads(future.result())
+        return guid, samples, subjects, tissues
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetches = {executor.submit(get_guid_data, auth, guid, trace_parent=parent,
+                                       dataset_ids=dataset_ids): guid for guid in guids}
+            processing = {}
+
+            for future in concurrent.futures.as_completed(fetches):
+                guid = fetches.pop(future)
+                logger.debug("Got data for %s" % guid)
+
+                if future.result() is None:
+                    yield guid, None, None, None
+                    continue
+
+                if process_executor is not None:
+                    processing[process_executor.submit(process_guid_data_pickled, future.result(),
+                                                       exclude_genomics_subjects,
+                                                       dataset_ids)] = (guid, time.time())
+
+                    for done in [x for x in processing if x.done()]:
+                        yield processed(done)
+                else:
+                    samples, subjects, tissues = process_guid_data(future.result(),
+                                                                   exclude_genomics_subjects,
+                                                                   dataset_ids)
+                    yield guid, samples, subjects, tissues
+
+            for future in concurrent.futures.as_completed(list(processing)):
+                yield processed(future)
+    finally:
+        if process_executor is not None:
+            process_executor.shutdown()
+
+
 def flattenjson(b, delim):
     val = {}
     for i in b.keys():
@@ -329,10 +625,12 @@ def flattenjson(b, delim):
 
     return val
 
+@flights.coalesce
+@trace.traced()
 def get_experiment(auth, experiment_id, verbose=False):
 
     url = "https://nda.nih.gov/api/experiment/{}".format(experiment_id)
-    r = requests.get(url, auth=auth, headers={'Accept': 'application/json'})
+    r = session.get(url, auth=auth, headers={'Accept': 'application/json'})
 
     if r.status_code != 200:
         raise requests.HTTPError("{} - {} - {}".format(r.status_code, r.url, r.body))
@@ -340,14 +638,52 @@ def get_experiment(auth, experiment_id, verbose=False):
     return r.json()
 
 
-def get_experiments(auth, experiment_ids, verbose=False):
+class ExperimentPrefetcher:
+    """Get experiments in the background as soon as their ids are known.
+
+    Each experiment is requested once, however many times its id is
+    prefetched, so ids can be sent as each GUID's samples arrive.
+
+    """
+
+    def __init__(self, auth, max_workers=4):
+        self.auth = auth
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, experiment_ids):
+        with self.lock:
+            for experiment_id in experiment_ids:
+                if experiment_id not in self.futures and not pandas.isnull(experiment_id):
+                    self.futures[experiment_id] = self.executor.submit(get_experiment, self.auth,
+                                                                       experiment_id)
+
+    def prefetch_samples(self, samples):
+        """Prefetch the experiments of a samples data frame."""
+
+        if 'experiment_id' in samples.columns:
+            self.prefetch(samples.experiment_id.drop_duplicates().tolist())
+
+    def get_experiment(self, experiment_id):
+        self.prefetch([experiment_id])
+        return self.futures[experiment_id].result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def get_experiments(auth, experiment_ids, verbose=False, prefetcher=None):
     df = []
 
     logger.info("Getting experiments.")
 
     for experiment_id in experiment_ids:
 
-        data = get_experiment(auth, experiment_id, verbose=verbose)
+        if prefetcher is not None:
+            data = prefetcher.get_experiment(experiment_id)
+        else:
+            data = get_experiment(auth, experiment_id, verbose=verbose)
         data_flat = flattenjson(data[u'omicsOrFMRIOrEEG']['sections'], '.')
         data_flat['experiment_id'] = experiment_id
 
@@ -357,6 +693,7 @@ def get_experiments(auth, experiment_ids, verbose=False):
     return df
 
 
+@trace.traced()
 def process_experiments(d):
 
     fix_keys = ['processing.processingKits.processingKit',
@@ -404,6 +741,40 @@ def process_experiments(d):
     return df2
 
 
+def merge_experiments(auth, metadata, verbose=False, prefetcher=None):
+    """Get the experiments in the metadata and merge them in by `experiment_id`.
+
+    Experiments already requested by an `ExperimentPrefetcher` are taken from it.
+
+    """
+
+    if verbose:
+        logger.info("Getting experiments")
+
+    experiment_ids = metadata.experiment_id.drop_duplicates().tolist()
+    logger.info("Experiments to get: %s" % (experiment_ids,))
+
+    if not experiment_ids:
+        logger.info("No experiments retrieved")
+        return metadata
+
+    if prefetcher is not None:
+        prefetcher.prefetch(experiment_ids)
+
+    expts = get_experiments(auth, experiment_ids, verbose=verbose, prefetcher=prefetcher)
+
+    expts = process_experiments(expts)
+    expts = expts.drop_duplicates()
+
+    logger.info("Experiments processed: %s" % (expts,))
+    metadata = metadata.merge(expts, how="left", left_on="experiment_id",
+                              right_on="experiment_id")
+    logger.info("Retrieved experiments.")
+
+    return metadata
+
+
+@trace.traced()
 def merge_tissues_subjects(tissues, subjects):
     """Merge together the tissue file and the subjects file.
 
@@ -425,6 +796,13 @@ def merge_tissues_subjects(tissues, subjects):
     return btb_subjects
 
 
+def empty_metadata():
+    """Get a metadata table with no rows, for when no samples are left to merge."""
+
+    return pandas.DataFrame(columns=['datasetid', 'data_file', 'md5', 'size'] + METADATA_COLUMNS)
+
+
+@trace.traced()
 def merge_tissues_samples(btb_subjects, samples):
     """Merge the tissue/subject with the samples to make a complete metadata table."""
 
@@ -437,6 +815,22 @@ def merge_tissues_samples(btb_subjects, samples):
     return metadata
 
 
+def iter_merge_tissues_samples(btb_subjects, samples, partitions=64, tmp_dir=None):
+    """Merge the tissue/subject with the samples out of core, yielding the metadata in chunks.
+
+    Like `merge_tissues_samples`, but both tables are spilled to disk in
+    `partitions` partitions first, so only one partition is in memory at a
+    time. The inputs can be data frames or iterables of data frame chunks.
+
+    """
+
+    on = ["src_subject_id", "subjectkey", "sample_id_biorepository"]
+
+    for metadata in join.hash_join(samples, btb_subjects, on, how="left", partitions=partitions,
+                                   tmp_dir=tmp_dir):
+        yield metadata.drop_duplicates()
+
+
 @deprecated(reason="Should not depend on bucket location to get manifests. Use NDASubmissionFiles class.")
 def get_manifests(bucket):
     """Get list of `.manifest` files from the NDA-BSMN bucket.
@@ -469,6 +863,7 @@ def get_manifests(bucket):
     return manifest
 
 
+@trace.traced()
 def merge_metadata_manifest(metadata, manifest):
     metadata_manifest = manifest.merge(metadata, how="left",
                                        left_on="filename",
@@ -479,11 +874,24 @@ def merge_metadata_manifest(metadata, manifest):
     return metadata_manifest
 
 
+def iter_merge_metadata_manifest(metadata, manifest, partitions=64, tmp_dir=None):
+    """Merge metadata into a manifest out of core, yielding the result in chunks.
+
+    Like `merge_metadata_manifest`, with the tables spilled to disk in
+    partitions as in `iter_merge_tissues_samples`.
+
+    """
+
+    for metadata_manifest in join.hash_join(manifest, metadata, "filename", right_on="data_file",
+                                            how="left", partitions=partitions, tmp_dir=tmp_dir):
+        yield metadata_manifest.drop_duplicates()
+
+
 def find_duplicate_filenames(metadata):
     """Find duplicates based on the basename of the data_file column.
 
     """
-    basenames = metadata.data_file.apply(lambda x: os.path.basename(x))
+    basenames = metadata.data_file.str.rsplit("/", n=1).str[-1]
     counts = basenames.value_counts()
 
     duplicates = counts[counts > 1].index
@@ -491,6 +899,149 @@ def find_duplicate_filenames(metadata):
     return (metadata[~basenames.isin(duplicates)],
             metadata[basenames.isin(duplicates)])
 
+def get_data_file_short_name(header):
+    """Get the structure short name from the first line of a submission data file.
+
+    The first line holds the structure name and version, e.g. `genomics_sample,03`,
+    which becomes `genomics_sample03`.
+
+    """
+
+    if isinstance(header, bytes):
+        header = header.decode('utf-8-sig')
+
+    fields = [x.strip().strip('"') for x in header.strip().split(",")]
+
+    try:
+        return "%s%02d" % (fields[0], int(fields[1]))
+    except (IndexError, ValueError):
+        return fields[0]
+
+
+def is_wanted_structure(content, short_names):
+    """Check if a data file is one of the structures in `short_names`, given at least its first line.
+
+    Short names are matched exactly, e.g. `genomics_sample03`. With no
+    `short_names`, every structure is wanted.
+
+    """
+
+    if not short_names:
+        return True
+
+    return get_data_file_short_name(content.split(b"\n", 1)[0]) in short_names
+
+
+@trace.traced()
+def read_submission_data_file(content):
+    """Read a submission data file from its downloaded bytes.
+
+    The structure is identified from the first line only, and the remaining
+    lines are parsed directly from the bytes buffer.
+
+    Returns a tuple of the structure short name and a data frame.
+
+    """
+
+    buf = io.BytesIO(content)
+    short_name = get_data_file_short_name(buf.readline())
+
+    try:
+        data = pandas.read_csv(buf, low_memory=False)
+    except pandas.errors.EmptyDataError:
+        logger.info("No data in the data file for %s" % (short_name, ))
+        data = pandas.DataFrame()
+
+    return short_name, data
+
+
+def get_submission_data_frames(submission_files, short_names=None):
+    """Read the data files of submissions and group them by structure.
+
+    Takes the `submission_files` of one or more `NDASubmission` objects and
+    returns a dictionary of structure short name to a data frame concatenated
+    across all submissions, with `collection_id` and `submission_id` columns added.
+    Optionally only keeps the structures in `short_names`.
+
+    """
+
+    data_frames = {}
+
+    for submission in submission_files:
+        for data_file in submission['files'].data_files:
+            content = data_file['content']
+
+            # Check the structure from the first line before parsing the whole file
+            if not is_wanted_structure(content, short_names):
+                continue
+
+            short_name, data = read_submission_data_file(content)
+
+            data['collection_id'] = submission['collection_id']
+            data['submission_id'] = submission['submission_id']
+            data_frames.setdefault(short_name, []).append(data)
+
+    return {short_name: pandas.concat(frames, ignore_index=True)
+            for short_name, frames in data_frames.items()}
+
+def submission_data_to_dfs(submission_files):
+    """Build the samples, subjects and tissues data frames from submission data files.
+
+    The data frames have the same columns as those from `get_sample_data_files`,
+    `subjects_to_df` and `tissues_to_df`, so they can be passed to `process_samples`,
+    `process_subjects` and `process_tissues`. Each submission is a dataset, so
+    the submission id is used as the `datasetid`. Data file md5s and sizes are
+    taken from the submissions' associated files where the paths match.
+
+    """
+
+    frames = get_submission_data_frames(submission_files,
+                                        short_names=[SAMPLE_STRUCTURE, SUBJECT_STRUCTURE,
+                                                     TISSUE_STRUCTURE])
+
+    def get_frame(short_name):
+        df = frames.get(short_name, pandas.DataFrame(columns=['collection_id', 'submission_id']))
+        df.columns = [x.lower() for x in df.columns]
+        return df
+
+    associated_files = pandas.DataFrame([f['name'] for submission in submission_files
+                                         for f in submission['files'].associated_files],
+                                        columns=['file_remote_path', 'md5sum', 'size'])
+    associated_files = associated_files.drop_duplicates('file_remote_path').set_index('file_remote_path')
+
+    samples = get_frame(SAMPLE_STRUCTURE)
+    samples['datasetid'] = samples['submission_id']
+
+    for col in samples.filter(regex=r"data_file\d+$").columns:
+        samples['%s_md5sum' % col] = samples[col].map(associated_files['md5sum'])
+        samples['%s_size' % col] = samples[col].map(associated_files['size'])
+
+    # Row ids of the structures, which are not in submitted data files
+    subjects = get_frame(SUBJECT_STRUCTURE).drop(['collection_id', 'submission_id'], axis=1)
+    subjects['genomics_subject02_id'] = None
+
+    tissues = get_frame(TISSUE_STRUCTURE).drop(['collection_id', 'submission_id'], axis=1)
+    tissues['nichd_btb02_id'] = None
+
+    return samples, subjects, tissues
+
+
+def get_collection_metadata(config, collection_ids):
+    """Get the samples, subjects and tissues data frames for NDA collections from their submissions."""
+
+    submission_files = []
+
+    for collection_id in collection_ids:
+        submissions = NDASubmission(config=config, collection_id=collection_id,
+                                    file_types=[NDASubmissionFiles.DATA_FILE,
+                                                NDASubmissionFiles.ASSOCIATED_FILE],
+                                    short_names=[SAMPLE_STRUCTURE, SUBJECT_STRUCTURE,
+                                                 TISSUE_STRUCTURE],
+                                    sniff=True)
+        submission_files.extend(submissions.submission_files)
+
+    return submission_data_to_dfs(submission_files)
+
 class NDASubmissionFiles:
 
     ASSOCIATED_FILE = 'Submission Associated File'
@@ -500,12 +1051,26 @@ class NDASubmissionFiles:
     SUBMISSION_TICKET = 'Submission Ticket'
     SUBMISSION_MEMENTO = 'Submission Memento'
 
-    def __init__(self, config, files):
+    SNIFF_BYTES = 1024
+
+    def __init__(self, config, files, file_types=None, short_names=None, sniff=False):
+        """Sort submission files by type and download their contents.
+
+        Optionally only download the file types in `file_types`, and only keep data
+        files whose structure short name is one of `short_names`. If `sniff`
+        is set, a data file's structure is read from its first bytes with a range
+        request before downloading the whole file.
+
+        """
+
         self.config = config # ApplicationProperties().get_config
         self.submission_api = self.config.get('submission.service.url')
         self.auth = (self.config.get('username'),
                      self.config.get('password'))
         self.headers = {'Accept': 'application/json'}
+        self.file_types = file_types
+        self.short_names = short_names
+        self.sniff = sniff
         (self.associated_files,
          self.data_files,
          self.manifest_file,
@@ -514,6 +1079,36 @@ class NDASubmissionFiles:
          self.submission_memento) = self.get_nda_submission_file_types(files)
         self.debug = True
 
+    def wanted_structure(self, content):
+        """Check if a data file's structure is one of the requested short names, given its first bytes."""
+
+        return is_wanted_structure(content, self.short_names)
+
+    def read_data_file(self, submission_file):
+        """Download a data file if its structure is wanted, otherwise return None.
+
+        If the first bytes can't be read with a range request, the whole
+        file is downloaded and checked instead.
+
+        """
+
+        if self.short_names and self.sniff:
+            head = self.read_file(submission_file, max_bytes=self.SNIFF_BYTES)
+
+            if head is not None and not self.wanted_structure(head):
+                logger.warning("Skipping data file %s, its structure is not one of %s." % (submission_file['id'],
+                                                                                         self.short_names))
+                return None
+
+        content = self.read_file(submission_file)
+
+        if not self.wanted_structure(content):
+            logger.warning("Skipping data file %s, its structure is not one of %s." % (submission_file['id'],
+                                                                                     self.short_names))
+            return None
+
+        return content
+
     def get_nda_submission_file_types(self, files):
         associated_files = []
         data_files = []
@@ -523,11 +1118,16 @@ class NDASubmissionFiles:
         submission_memento = []
 
         for file in files:
+            if self.file_types is not None and file['file_type'] not in self.file_types:
+                continue
+
             if file['file_type'] == self.ASSOCIATED_FILE:
                 associated_files.append({'name': file})
             elif file['file_type'] == self.DATA_FILE:
-                data_files.append({'name': file,
-                                   'content': self.read_file(file)})
+                content = self.read_data_file(file)
+                if content is not None:
+                    data_files.append({'name': file,
+                                       'content': content})
             elif file['file_type'] == self.MANIFEST_FILE:
                 manifest_file.append({'name': file,
                                       'content': self.read_file(file)})
@@ -547,20 +1147,52 @@ class NDASubmissionFiles:
                 submission_ticket,
                 submission_memento)
 
-    def read_file(self, submission_file):
+    def read_file(self, submission_file, max_bytes=None):
+        """Download a submission file, or only its first `max_bytes` bytes.
+
+        Returns None if the first bytes were requested and the response was
+        not the file (a status other than 200 or 206).
+
+        """
+
         download_url = submission_file['_links']['download']['href']
-        request = requests.get(
+
+        if max_bytes is None:
+            request = session.get(
+                download_url,
+                auth=self.auth,
+                hedge=False
+            )
+            return request.content
+
+        request = session.get(
             download_url,
-            auth=self.auth
+            auth=self.auth,
+            headers={'Range': 'bytes=0-{}'.format(max_bytes - 1)},
+            stream=True
         )
-        return request.content
+
+        try:
+            if request.status_code not in (200, 206):
+                logger.warning("Range request for %s failed with status %s." % (download_url,
+                                                                                  request.status_code))
+                return None
+
+            # Servers that ignore the range send the whole file, so stop reading early
+            return request.raw.read(max_bytes, decode_content=True)
+        finally:
+            request.close()
 
 
 class NDASubmission:
 
-    def __init__(self, config, submission_id=None, collection_id=None):
+    def __init__(self, config, submission_id=None, collection_id=None,
+                 file_types=None, short_names=None, sniff=False):
 
         self.config = config # ApplicationProperties().get_config
+        self.file_types = file_types
+        self.short_names = short_names
+        self.sniff = sniff
         self.submission_api = self.config.get('submission.service.url')
         self.auth = (self.config.get('username'),
                      self.config.get('password'))
@@ -575,7 +1207,7 @@ class NDASubmission:
 
     def get_submissions_for_collection(self, status="Upload Completed"):
 
-        request = requests.get(
+        request = session.get(
             self.submission_api,
             params={'collectionId': self.collection_id,
                     'usersOwnSubmissions': False,
@@ -594,7 +1226,7 @@ class NDASubmission:
     def get_submission_files(self):
         submission_files = []
         for s in self.submissions:
-            request = requests.get(
+            request = session.get(
                 self.submission_api + '/{}'.format(s),
                 headers=self.headers,
                 auth=self.auth
@@ -609,7 +1241,7 @@ class NDASubmission:
                 logger.error('Request ({}) returned {}'.format(request.url, request.text))
 
             files = []
-            request = requests.get(
+            request = session.get(
                 self.submission_api + '/{}/files'.format(s),
                 headers=self.headers,
                 auth=self.auth
@@ -622,7 +1254,10 @@ class NDASubmission:
             except json.decoder.JSONDecodeError:
                 logger.error('Error occurred retrieving files from submission {}'.format(s))
                 logger.error('Request ({}) returned {}'.format(request.url, request.text))
-            submission_files.append({'files': NDASubmissionFiles(self.config, files),
+            submission_files.append({'files': NDASubmissionFiles(self.config, files,
+                                                                 file_types=self.file_types,
+                                                                 short_names=self.short_names,
+                                                                 sniff=self.sniff),
                                      'collection_id': collection_id,
                                      'submission_id': s})
         return submission_files
@@ -0,0 +1,156 @@
+"""Run work as concurrent stages joined by bounded queues.
+
+Each `Stage` has its own worker threads, which take items from the stage's
+input queue and put their results on the next stage's queue. Queues hold at
+most `maxsize` items, so a stage that gets ahead blocks until the stage after
+it catches up. Memory stays bounded and the slowest stage sets the pace.
+
+"""
+
+import queue
+import logging
+import threading
+
+from . import trace
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Put on a queue once for each worker of the stage reading it when there are no more items
+_DONE = object()
+
+POLL_SECONDS = 0.1
+
+
+class Stage:
+
+    def __init__(self, name, func, workers=1):
+        """A pipeline stage running `func` on each item with `workers` threads.
+
+        `func` returns an iterable of items for the next stage, which may be
+        empty, or None for no items.
+
+        """
+
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+class _Run:
+
+    def __init__(self, stages, maxsize, stopped=None):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]
+        self.stopped = stopped or threading.Event()
+        self.errors = []
+        self.running = [stage.workers for stage in stages]
+        self.lock = threading.Lock()
+
+    def put(self, n, item):
+        while not self.stopped.is_set():
+            try:
+                self.queues[n].put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, n):
+        while not self.stopped.is_set():
+            try:
+                return self.queues[n].get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+
+        return _DONE
+
+    def finish(self, n):
+        """Signal the workers reading queue `n` that there are no more items."""
+
+        readers = self.stages[n].workers if n < len(self.stages) else 1
+
+        for _ in range(readers):
+            self.put(n, _DONE)
+
+    def fail(self, error):
+        with self.lock:
+            self.errors.append(error)
+        self.stopped.set()
+
+    def feed(self, source):
+        try:
+            for item in source:
+                if self.stopped.is_set():
+                    return
+                self.put(0, item)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.finish(0)
+
+    def work(self, n):
+        stage = self.stages[n]
+
+        try:
+            while True:
+                item = self.get(n)
+
+                if item is _DONE:
+                    break
+
+                with trace.span("pipeline.%s" % (stage.name, )):
+                    results = stage.func(item)
+
+                for result in results or ():
+                    self.put(n + 1, result)
+        except Exception as e:
+            logger.error("Stage %s failed: %s" % (stage.name, e))
+            self.fail(e)
+        finally:
+            with self.lock:
+                self.running[n] -= 1
+                last = self.running[n] == 0
+
+            if last:
+                self.finish(n + 1)
+
+
+def run(source, stages, maxsize=16, stopped=None):
+    """Pass the items of `source` through `stages` and yield the items the last stage returns.
+
+    If a stage raises an exception, the pipeline stops and the first
+    exception is raised here. If a `threading.Event` is given as `stopped`,
+    it is set when the pipeline stops, so stage functions that wait on
+    something other than the queues can give up.
+
+    """
+
+    pipeline = _Run(stages, maxsize, stopped=stopped)
+
+    threads = [threading.Thread(target=pipeline.feed, args=(source, ), name="pipeline-source")]
+
+    for n, stage in enumerate(stages):
+        threads.extend(threading.Thread(target=pipeline.work, args=(n, ),
+                                        name="pipeline-%s-%s" % (stage.name, i))
+                       for i in range(stage.workers))
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = pipeline.get(len(stages))
+
+            if item is _DONE:
+                break
+
+            yield item
+    finally:
+        pipeline.stopped.set()
+
+        for thread in threads:
+            thread.join()
+
+    if pipeline.errors:
+        raise pipeline.errors[0]
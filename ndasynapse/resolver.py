@@ -0,0 +1,165 @@
+"""Resolve Synapse file names for NDA data files.
+
+All files are stored in a single Synapse folder, so files with the same
+basename need unique names. Colliding files are prefixed with a slug of a
+UUID derived from the project namespace and the full data file path.
+
+"""
+
+import uuid
+import logging
+
+import pandas
+import synapseclient
+
+from . import cache
+from . import trace
+from . import synapse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+NAMESPACE_CACHE_FILE = 'namespaces.json'
+
+REGISTRY_COLUMNS = ['data_file', 'fileName']
+
+
+def basenames(data_files):
+    """Vectorized `os.path.basename` for a series of paths."""
+
+    return data_files.str.rsplit("/", n=1).str[-1]
+
+
+def get_cached_namespace(project_id, syn=None, cache_dir=None):
+    """Get the namespace UUID of a Synapse project, using a local cache first."""
+
+    path = cache.cache_path(NAMESPACE_CACHE_FILE, cache_dir=cache_dir)
+    namespaces = cache.read_json(path, default={})
+
+    try:
+        return uuid.UUID(namespaces[project_id])
+    except KeyError:
+        pass
+
+    if syn is None:
+        syn = synapseclient.login(silent=True)
+
+    namespace = synapse.get_namespace(syn, project_id)
+
+    namespaces[project_id] = namespace
+    cache.write_json(path, namespaces)
+
+    return uuid.UUID(namespace)
+
+
+class FilenameResolver:
+    """Assign unique Synapse file names to data files.
+
+    If a `registry_path` is given, the names already assigned are read from
+    and saved to it, so a data file keeps its name across runs and only new
+    data files are checked for collisions. A new file colliding with a name
+    already assigned is renamed; the existing file keeps its name.
+
+    """
+
+    def __init__(self, project_id, syn=None, registry_path=None, cache_dir=None):
+        self.project_id = project_id
+        self.syn = syn
+        self.registry_path = registry_path
+        self.cache_dir = cache_dir
+        self._namespace = None
+
+        if registry_path:
+            try:
+                self.registry = pandas.read_csv(registry_path, dtype=str)[REGISTRY_COLUMNS]
+            except (IOError, OSError):
+                self.registry = pandas.DataFrame(columns=REGISTRY_COLUMNS)
+        else:
+            self.registry = pandas.DataFrame(columns=REGISTRY_COLUMNS)
+
+        self.registry = self.registry.drop_duplicates('data_file')
+
+    @property
+    def namespace(self):
+        if self._namespace is None:
+            self._namespace = get_cached_namespace(self.project_id, syn=self.syn,
+                                                   cache_dir=self.cache_dir)
+        return self._namespace
+
+    def slugs(self, data_files):
+        """Get the UUID slugs for a series of data files, computing each distinct path once."""
+
+        unique_data_files = data_files.drop_duplicates()
+        slugs = pandas.Series([synapse.uuid2slug(uuid.uuid3(self.namespace, x))
+                               for x in unique_data_files],
+                              index=unique_data_files.values)
+
+        return data_files.map(slugs)
+
+    def split_named(self, metadata):
+        """Split metadata into rows whose data files already have names and the rest.
+
+        Returns the rows with names, with a `fileName` column added, and the
+        rows of new data files, which can only be named once it is known
+        which other files share their basenames.
+
+        """
+
+        names = metadata.data_file.map(self.registry.set_index('data_file')['fileName'])
+        named = names.notnull()
+
+        return metadata[named].assign(fileName=names[named]), metadata[~named]
+
+    @trace.traced("resolver.resolve")
+    def resolve(self, metadata):
+        """Add a `fileName` column to the metadata.
+
+        If the project namespace can't be found, colliding files are dropped.
+
+        """
+
+        metadata = metadata.copy()
+        names = metadata.data_file.map(self.registry.set_index('data_file')['fileName'])
+
+        new = names.isnull()
+        new_files = metadata.data_file[new].drop_duplicates()
+        new_basenames = basenames(new_files)
+
+        # Counted per metadata row, as in `nda.find_duplicate_filenames`, so a
+        # data file on several rows is renamed too
+        counts = basenames(metadata.data_file[new]).value_counts()
+        taken = set(self.registry.fileName) | set(counts[counts > 1].index)
+
+        colliding_files = new_files[new_basenames.isin(taken)]
+        new_names = pandas.Series(new_basenames.values, index=new_files.values)
+
+        if colliding_files.shape[0] > 0:
+            logger.info("Renaming %s files with duplicate names." % (colliding_files.shape[0], ))
+
+            try:
+                slugs = self.slugs(colliding_files)
+            except KeyError:
+                logger.info("Couldn't get namespace. Not processing bad files")
+                keep = ~metadata.data_file.isin(colliding_files)
+                metadata = metadata[keep]
+                names = names[keep]
+                new_files = new_files[~new_files.isin(colliding_files)]
+                new_names = new_names[new_files.values]
+            else:
+                new_names[colliding_files.values] = (slugs + "_" + basenames(colliding_files)).values
+
+        metadata['fileName'] = names.fillna(metadata.data_file.map(new_names))
+
+        self.registry = pandas.concat([self.registry,
+                                       pandas.DataFrame({'data_file': new_names.index,
+                                                         'fileName': new_names.values})],
+                                      ignore_index=True)
+
+        return metadata
+
+    def save(self):
+        """Save the registry of assigned names, if a registry path was given."""
+
+        if self.registry_path:
+            cache.atomic_write(self.registry_path,
+                               lambda f: self.registry.to_csv(f, index=False))
@@ -0,0 +1,124 @@
+"""Verify that the S3 objects in a manifest exist and match before linking them in Synapse.
+
+"""
+
+import hashlib
+import logging
+import concurrent.futures
+
+import boto3
+import botocore.config
+import botocore.exceptions
+import pandas
+
+from . import cache
+from . import trace
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+MD5_CACHE_FILE = 's3_md5.json'
+
+STATUS_OK = 'ok'
+STATUS_MISSING = 'missing'
+STATUS_SIZE_MISMATCH = 'size_mismatch'
+STATUS_MD5_MISMATCH = 'md5_mismatch'
+STATUS_ERROR = 'error'
+
+
+def get_client(max_workers=16, **kwargs):
+    """Get an S3 client with a connection pool large enough for `max_workers` threads."""
+
+    config = botocore.config.Config(max_pool_connections=max_workers)
+
+    return boto3.client('s3', config=config, **kwargs)
+
+
+def compute_md5(client, bucket, key, chunk_size=8 * 1024 * 1024):
+    """Compute the md5 of an S3 object by streaming it."""
+
+    body = client.get_object(Bucket=bucket, Key=key)['Body']
+    md5 = hashlib.md5()
+
+    for chunk in iter(lambda: body.read(chunk_size), b''):
+        md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def verify_s3_object(client, bucket, key, size, md5, md5_cache, compute_md5_multipart=False):
+    """Check one S3 object against its expected size and md5.
+
+    The ETag is the md5 for objects not uploaded in parts. For multipart
+    objects the md5 is only checked if `compute_md5_multipart` is set, and the
+    computed md5 is cached by key and last modified date.
+
+    Returns a tuple of a status and the md5 if it was checked.
+
+    """
+
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return STATUS_MISSING, None
+        logger.error("Could not check s3://%s/%s: %s" % (bucket, key, e))
+        return STATUS_ERROR, None
+
+    if not pandas.isnull(size) and int(size) != head['ContentLength']:
+        return STATUS_SIZE_MISMATCH, None
+
+    etag = head['ETag'].strip('"')
+
+    if '-' not in etag:
+        object_md5 = etag
+    else:
+        cache_key = "%s|%s" % (key, head['LastModified'].isoformat())
+        object_md5 = md5_cache.get(cache_key)
+
+        if object_md5 is None and compute_md5_multipart:
+            object_md5 = compute_md5(client, bucket, key)
+            md5_cache[cache_key] = object_md5
+
+    if object_md5 is not None and not pandas.isnull(md5) and object_md5 != md5:
+        return STATUS_MD5_MISMATCH, object_md5
+
+    return STATUS_OK, object_md5
+
+
+@trace.traced()
+def verify_s3_objects(metadata_manifest, storage_location, client=None, max_workers=16,
+                      compute_md5_multipart=False, cache_dir=None):
+    """Check the S3 objects of a manifest concurrently.
+
+    Objects are found from the `data_file` column relative to the storage
+    location's bucket, and compared to the `size` and `md5` columns.
+
+    Returns a data frame with the same index as the manifest and columns
+    `s3_status` and `s3_md5`.
+
+    """
+
+    if client is None:
+        client = get_client(max_workers=max_workers)
+
+    bucket = storage_location['bucket']
+    keys = metadata_manifest.data_file.str.replace("s3://%s/" % (bucket, ), "", regex=False)
+
+    md5_cache_path = cache.cache_path(MD5_CACHE_FILE, cache_dir=cache_dir)
+    md5_cache = cache.read_json(md5_cache_path, default={})
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda x: verify_s3_object(client, bucket, x[0], x[1], x[2],
+                                                               md5_cache, compute_md5_multipart),
+                                    zip(keys, metadata_manifest['size'], metadata_manifest['md5'])))
+
+    if compute_md5_multipart:
+        cache.write_json(md5_cache_path, md5_cache)
+
+    verified = pandas.DataFrame(results, columns=['s3_status', 's3_md5'],
+                                index=metadata_manifest.index)
+
+    logger.info("Verified S3 objects: %s" % (verified.s3_status.value_counts().to_dict(), ))
+
+    return verified
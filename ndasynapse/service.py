@@ -0,0 +1,131 @@
+"""Serve command line invocations from a long-running process.
+
+A `QueryServer` keeps its process, imports, sessions and caches warm
+between calls. Clients POST `{"argv": [...]}` as JSON to `/run` and get the
+command's output back as the response body.
+
+"""
+
+import io
+import json
+import time
+import logging
+import threading
+import traceback
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8787
+
+
+class UsageError(Exception):
+    """Raised by a run function for invalid command lines."""
+    pass
+
+
+class QueryServer:
+
+    def __init__(self, run, host=DEFAULT_HOST, port=DEFAULT_PORT, cache_ttl=300, cacheable=None):
+        """Serve `run(argv, out)`, which writes a command's output to the binary file object `out`.
+
+        Successful outputs are cached in memory for `cache_ttl` seconds,
+        keyed by the command line. If given, `cacheable(argv)` says whether a
+        command line's output can be cached; commands with side effects,
+        like writing files or saving state, must be run every time.
+
+        """
+
+        self.run = run
+        self.cache_ttl = cache_ttl
+        self.cacheable = cacheable
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+
+    def _cached(self, key):
+        with self.lock:
+            try:
+                (created, body) = self.cache[key]
+            except KeyError:
+                return None
+
+            if time.time() - created > self.cache_ttl:
+                del self.cache[key]
+                return None
+
+            return body
+
+    def handle(self, argv):
+        """Run a command line, returning a tuple of HTTP status and response body."""
+
+        key = tuple(argv)
+        cacheable = self.cache_ttl and (self.cacheable is None or self.cacheable(argv))
+        body = self._cached(key) if cacheable else None
+
+        if body is not None:
+            logger.debug("Cached response for %s" % (argv, ))
+            return 200, body
+
+        out = io.BytesIO()
+
+        try:
+            self.run(argv, out)
+        except UsageError as e:
+            return 400, str(e).encode('utf-8')
+        except Exception:
+            return 500, traceback.format_exc().encode('utf-8')
+
+        body = out.getvalue()
+
+        if cacheable:
+            with self.lock:
+                self.cache[key] = (time.time(), body)
+
+        return 200, body
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if self.path != '/run':
+                    self.send_error(404)
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    argv = json.loads(self.rfile.read(length).decode('utf-8'))['argv']
+                except (ValueError, KeyError):
+                    self.send_error(400, "Expected a JSON body with an 'argv' list.")
+                    return
+
+                start = time.time()
+                status, body = service.handle(argv)
+                logger.info("%s %s in %.3fs" % (status, argv, time.time() - start))
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve_forever(self):
+        logger.info("Serving on http://%s:%s" % self.server.server_address[:2])
+        self.server.serve_forever()
@@ -0,0 +1,37 @@
+"""Deterministic partitioning of GUIDs and manifest rows across processes and machines.
+
+A shard is given as `i/N`, the i-th (counting from 0) of N shards. Values are
+assigned to shards by a CRC32 hash, which is the same on every machine and
+Python version.
+
+"""
+
+import zlib
+
+
+def parse_shard(shard):
+    """Parse a shard specification like `2/8` to a tuple of shard index and count."""
+
+    try:
+        index, count = [int(x) for x in shard.split("/")]
+    except ValueError:
+        raise ValueError("Shard must look like i/N, not %s" % (shard, ))
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard index must be from 0 to N-1, not %s" % (shard, ))
+
+    return index, count
+
+
+def shard_of(value, count):
+    """Get the shard index of a value."""
+
+    return zlib.crc32(str(value).encode('utf-8')) % count
+
+
+def in_shard(values, shard):
+    """Get a list of booleans for which values are in a shard given as `i/N`."""
+
+    index, count = parse_shard(shard)
+
+    return [shard_of(x, count) == index for x in values]
@@ -0,0 +1,50 @@
+"""Stream manifest rows between processes as newline-delimited JSON.
+
+Each row is a JSON object on its own line. A blank line ends a batch, so a
+consumer can start on the rows of one GUID while the producer is still
+working on the next. Rows of a stream may have different columns.
+
+"""
+
+import json
+import logging
+
+import pandas
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def write_batch(manifest, out):
+    """Write a batch of manifest rows to a stream and flush it."""
+
+    if manifest.shape[0] > 0:
+        out.write(manifest.to_json(orient='records', lines=True, date_format='iso').rstrip("\n"))
+        out.write("\n")
+
+    out.write("\n")
+    out.flush()
+
+
+def iter_batches(lines, chunksize=None):
+    """Read batches of manifest rows from a stream written by `write_batch`.
+
+    A data frame is yielded at the end of each batch, or sooner once it has
+    `chunksize` rows. Use `chunksize` to bound the size of large batches.
+
+    """
+
+    records = []
+
+    for line in lines:
+        line = line.strip()
+
+        if line:
+            records.append(json.loads(line))
+
+        if records and (not line or (chunksize and len(records) >= chunksize)):
+            yield pandas.DataFrame.from_records(records)
+            records = []
+
+    if records:
+        yield pandas.DataFrame.from_records(records)
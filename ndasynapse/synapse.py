@@ -1,5 +1,6 @@
 import os
 import json
+import functools
 import uuid
 import logging
 import base64
@@ -7,6 +8,9 @@ import base64
 import pandas
 import synapseclient
 
+from . import trace
+from . import client
+
 pandas.options.display.max_rows = None
 pandas.options.display.max_columns = None
 pandas.options.display.max_colwidth = 1000
@@ -21,28 +25,248 @@ logger.setLevel(logging.DEBUG)
 # Synapse configuration
 dry_run = False
 
+PROJECT_ID = 'syn5902559'
+
 content_type_dict = {'.gz': 'application/x-gzip',
                      '.bam': 'application/octet-stream',
                      '.zip': 'application/zip'}
 
+# File view columns that are not annotations
+VIEW_SYSTEM_COLUMNS = ['id', 'name', 'parentId', 'path', 'type', 'etag', 'currentVersion',
+                       'benefactorId', 'projectId', 'createdOn', 'createdBy', 'modifiedOn',
+                       'modifiedBy', 'dataFileHandleId', 'dataFileName', 'dataFileSizeBytes',
+                       'dataFileMD5Hex', 'dataFileConcreteType', 'dataFileBucket', 'dataFileKey']
+
+PLAN_CREATE = 'create'
+PLAN_UPDATE = 'update'
+PLAN_REPLACE = 'replace'
+PLAN_NOOP = 'noop'
+
+# Concurrent lookups of the same Synapse resource share one response
+flights = client.SingleFlight("synapse")
+
+
+def _sql_value(value):
+    value = str(value)
 
-def check_existing_by_datasetid(syn, datasetids, file_view_id):
+    if value.isdigit():
+        return value
+
+    return "'%s'" % (value.replace("'", "''"), )
+
+
+@trace.traced()
+def check_existing_by_datasetid(syn, datasetids, file_view_id, batch_size=500, index=None):
     """Check a file view that has a 'datasetid' column to see which datasetids exist.
 
-    """
+    The given datasetids are looked up in batched `IN` queries. If a `FileViewIndex`
+    of the view's datasetid column is given, it is refreshed and checked instead.
 
-    res = syn.tableQuery('select id,datasetid from %s' % (file_view_id, ))
-    d = res.asDataFrame()
+    """
 
-    existing_datasetids = set(d.datasetid.tolist())
     given_datasetids = set(datasetids)
+    given = pandas.Series(list(given_datasetids), dtype=object)
+    given = dict(zip(_normalize_values(given), given))
+
+    if index is not None:
+        existing = set(_normalize_values(index.refresh().datasetid.dropna()))
+    else:
+        existing = set()
+        given_list = list(given.values())
 
-    return {'exists': given_datasetids.intersection(existing_datasetids),
+        for i in range(0, len(given_list), batch_size):
+            batch = given_list[i:i + batch_size]
+            res = syn.tableQuery('select id,datasetid from %s where datasetid in (%s)' % (file_view_id,
+                                                                                          ",".join(map(_sql_value, batch))))
+            d = res.asDataFrame()
+            existing.update(_normalize_values(d.datasetid.dropna()))
+
+    existing_datasetids = {given[x] for x in existing if x in given}
+
+    return {'exists': existing_datasetids,
             'not_exists': given_datasetids.difference(existing_datasetids)}
 
 
-def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose=False):
-    """Create a list of Synapse file handles (S3FileHandles) to link to."""
+@trace.traced()
+def get_file_view(syn, file_view_id, parent_id=None):
+    """Get all rows of a file view, optionally only those in a parent container."""
+
+    query = 'select * from %s' % (file_view_id, )
+
+    if parent_id:
+        query += " where parentId = '%s'" % (parent_id, )
+
+    return syn.tableQuery(query).asDataFrame()
+
+
+def _normalize_values(column):
+    """Convert a column to strings so that values read from a manifest and a file view compare equal."""
+
+    text = column.astype(str).where(column.notnull(), '')
+    numbers = pandas.to_numeric(column, errors='coerce')
+
+    return text.where(numbers.isnull(), numbers.astype(float).astype(str))
+
+
+def row_fingerprints(df, columns):
+    """Hash the given columns of each row to a single value."""
+
+    values = pandas.DataFrame({col: _normalize_values(df[col]) for col in columns},
+                              index=df.index, columns=columns)
+
+    return pandas.util.hash_pandas_object(values, index=False)
+
+
+@trace.traced()
+def plan_store(synapse_manifest, file_view):
+    """Compare a manifest to the rows of a file view to find what needs to be stored.
+
+    Rows are matched on `name` and `parentId`. Matched rows whose `md5`
+    differs from the view's `dataFileMD5Hex` need a new version of the file
+    and are replaces. Other matched rows whose annotations differ from the
+    file view are updates, the rest are no-ops. Unmatched rows are creates.
+    Only annotations that are columns of the file view are compared.
+
+    Returns a data frame with the same index as the manifest and columns
+    `action` and `id` (the existing entity id).
+
+    """
+
+    keys = ['name', 'parentId']
+
+    columns = [col for col in synapse_manifest.columns
+               if col in file_view.columns and col not in VIEW_SYSTEM_COLUMNS]
+
+    compare_md5 = 'md5' in synapse_manifest.columns and 'dataFileMD5Hex' in file_view.columns
+
+    missing = [col for col in synapse_manifest.columns
+               if col not in file_view.columns and col not in VIEW_SYSTEM_COLUMNS
+               and not (compare_md5 and col == 'md5')]
+
+    if missing:
+        logger.warning("Columns not in the file view are not compared: %s" % (missing, ))
+
+    existing = file_view[keys + ['id']].assign(view_fingerprint=row_fingerprints(file_view, columns).values)
+    manifest_keys = synapse_manifest[keys].assign(fingerprint=row_fingerprints(synapse_manifest, columns).values)
+
+    if compare_md5:
+        existing = existing.assign(view_md5=file_view.dataFileMD5Hex.values)
+        manifest_keys = manifest_keys.assign(md5=synapse_manifest.md5.values)
+
+    matched = manifest_keys.merge(existing.drop_duplicates(keys), how='left', on=keys)
+
+    action = pandas.Series(PLAN_UPDATE, index=matched.index)
+    action[matched.id.isnull()] = PLAN_CREATE
+    action[matched.fingerprint == matched.view_fingerprint] = PLAN_NOOP
+
+    if compare_md5:
+        md5 = matched.md5.astype(str).str.lower()
+        view_md5 = matched.view_md5.astype(str).str.lower()
+        replaced = matched.id.notnull() & matched.md5.notnull() & matched.view_md5.notnull() & (md5 != view_md5)
+        action[replaced] = PLAN_REPLACE
+
+    plan = pandas.DataFrame({'action': action.values, 'id': matched.id.values},
+                            index=synapse_manifest.index)
+
+    logger.info("Store plan: %s" % (plan.action.value_counts().to_dict(), ))
+
+    return plan
+
+
+def update_annotations(syn, synapse_manifest, file_view_id, ids, batch_size=5000,
+                       query_batch_size=500, journal=None):
+    """Update the annotations of existing entities as row changes to a file view.
+
+    `ids` are the entity ids of the manifest rows (e.g. the `id` column of
+    `plan_store`). For each batch of entities, their view rows are read, the
+    manifest values of the annotation columns in the view are set, and the
+    rows are stored as one table transaction instead of one entity update
+    per file. If a `StoreJournal` is given, each updated row is recorded.
+
+    Returns the ids that were updated. Entities not in the view are skipped.
+
+    """
+
+    view_columns = [col['name'] for col in syn.getTableColumns(file_view_id)]
+    columns = [col for col in synapse_manifest.columns
+               if col in view_columns and col not in VIEW_SYSTEM_COLUMNS]
+
+    if not columns:
+        logger.warning("No annotation columns of the manifest are in file view %s, nothing to update." % (
+            file_view_id, ))
+        return []
+
+    updates = synapse_manifest.assign(id=list(ids)).dropna(subset=['id'])
+    updates = updates.drop_duplicates('id', keep='last').set_index('id')
+
+    updated = []
+
+    for n, start in enumerate(range(0, updates.shape[0], batch_size)):
+        batch = updates.iloc[start:start + batch_size]
+        batch_ids = batch.index.tolist()
+
+        view_rows = []
+
+        for i in range(0, len(batch_ids), query_batch_size):
+            query_ids = batch_ids[i:i + query_batch_size]
+            res = syn.tableQuery('select id,currentVersion,%s from %s where id in (%s)' % (
+                ",".join(columns), file_view_id, ",".join(map(_sql_value, query_ids))))
+            view_rows.append(res.asDataFrame())
+
+        view_rows = pandas.concat(view_rows)
+
+        if view_rows.shape[0] < len(batch_ids):
+            logger.warning("%s entities are not in file view %s and were not updated." % (
+                len(batch_ids) - view_rows.shape[0], file_view_id))
+
+        if view_rows.empty:
+            continue
+
+        new_values = batch.loc[view_rows.id, columns]
+        new_values.index = view_rows.index
+        view_rows[columns] = new_values.astype(object).where(new_values.notnull(), None)
+
+        with trace.span("synapse.update_view", rows=view_rows.shape[0]):
+            syn.store(synapseclient.Table(file_view_id, view_rows))
+
+        if journal is not None and 'data_file' in batch:
+            for (entity_id, version) in zip(view_rows.id, view_rows.currentVersion):
+                journal.record_entity(batch.data_file[entity_id], entity_id, int(version))
+
+        updated.extend(view_rows.id)
+
+        logger.info("Transaction %s: updated annotations of %s entities (%s of %s)." % (
+            n + 1, view_rows.shape[0], min(start + batch_size, updates.shape[0]), updates.shape[0]))
+
+    return updated
+
+
+def get_entities_by_md5(syn, md5, md5_index=None):
+    """Get the entities with a file md5, from an `Md5Index` if given and it has them, otherwise from Synapse."""
+
+    if md5_index is not None:
+        res = md5_index.lookup(md5)
+
+        if res:
+            return res
+
+    return _get_md5_entities(syn, md5)
+
+
+@flights.coalesce
+def _get_md5_entities(syn, md5):
+    with trace.span("synapse.md5_lookup", md5=md5):
+        return syn.restGET("/entity/md5/%s" % (md5, ))['results']
+
+
+@trace.traced()
+def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose=False, md5_index=None):
+    """Create a list of Synapse file handles (S3FileHandles) to link to.
+
+    Files already in Synapse get their existing file handle. With an `Md5Index`,
+    these are only the file handle ids, without a call to Synapse.
+
+    """
 
     fh_list = []
 
@@ -58,14 +282,20 @@ def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose
         contentMd5 = x['md5']
 
         # Check if it exists in Synapse
-        res = syn.restGET("/entity/md5/%s" % (contentMd5, ))['results']
+        res = get_entities_by_md5(syn, contentMd5, md5_index=md5_index)
 
         if verbose:
             logger.info("Checked for md5 %s" % contentMd5)
 
         # res = filter(lambda x: x['benefactorId'] == synapse_data_folder_id, res)
 
-        if len(res) > 0:
+        if len(res) > 0 and res[0].get('dataFileHandleId'):
+            fileHandle = {'id': res[0]['dataFileHandleId']}
+
+            if verbose:
+                logger.info("Got filehandle for %s from index" % fileHandle['id'])
+
+        elif len(res) > 0:
             fhs = [syn.restGET("/entity/%(id)s/version/%(versionNumber)s/filehandles" % er) for er in res]
             fileHandle = syn._getFileHandle(fhs[0]['list'][0]['id'])
 
@@ -92,39 +322,50 @@ def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose
 
     return fh_list
 
-def get_filehandles_by_md5(syn, md5):
-    res = syn.restGET("/entity/md5/%s" % md5)
+def get_filehandles_by_md5(syn, md5, md5_index=None):
+    """Get the file handles of the entities with a file md5.
 
-    fhs = [syn.restGET("/entity/%(id)s/version/%(versionNumber)s/filehandles" % er) for er in res]
+    Each item is shaped like the `/entity/{id}/version/{version}/filehandles`
+    response. File handles found in an `Md5Index` only have their id.
+
+    """
+
+    res = get_entities_by_md5(syn, md5, md5_index=md5_index)
+
+    fhs = [{'list': [{'id': er['dataFileHandleId']}]} if er.get('dataFileHandleId')
+           else syn.restGET("/entity/%(id)s/version/%(versionNumber)s/filehandles" % er)
+           for er in res]
 
     return fhs
 
 
-def entity_by_md5(syn, contentMd5, parentId=None, cmp=None):
+def entity_by_md5(syn, contentMd5, parentId=None, cmp=None, md5_index=None):
     """Gets the first entity in a list of entities identified by md5.
 
     Optionally takes a comparison function to pass to sorted
-    and a parent id for filtering.
+    and a parent id for filtering. Only the entity metadata is
+    retrieved; the file is not downloaded.
 
     """
 
     # Check if it exists in Synapse
-    res = syn.restGET("/entity/md5/%s" % (contentMd5, ))['results']
+    res = get_entities_by_md5(syn, contentMd5, md5_index=md5_index)
 
     if cmp:
-        res = sorted(res, cmp=cmp)
+        res = sorted(res, key=functools.cmp_to_key(cmp))
 
     if parentId:
-        res = filter(lambda x: x['parentId'] == parentId, res)
+        res = [x for x in res if x['parentId'] == parentId]
 
     try:
-        entity = syn.get(res[0]['id'], version=res[0]['versionNumber'])
-    except KeyError:
+        entity = syn.get(res[0]['id'], version=res[0]['versionNumber'], downloadFile=False)
+    except (KeyError, IndexError):
         entity = None
 
     return entity
 
 
+@flights.coalesce
 def get_namespace(syn, projectId):
     return syn.getAnnotations(projectId)['namespace_uuid'][0]
 
@@ -136,7 +377,15 @@ def uuid2slug(uuid):
 def slug2uuid(slug):
     return uuid.UUID(bytes=base64.urlsafe_b64decode((slug + '==').replace('_', '/')))
 
-def store(syn, synapse_manifest, filehandles, verbose=False, ignore_errors=False):
+@trace.traced()
+def store(syn, synapse_manifest, filehandles, verbose=False, ignore_errors=False, journal=None):
+    """Store entities from a manifest, creating their external file handles if needed.
+
+    If a `StoreJournal` is given, rows already stored are skipped, file handles
+    already created are reused, and each new file handle and entity is recorded.
+    Rows are identified by their `data_file`.
+
+    """
 
     f_list = []
 
@@ -144,19 +393,32 @@ def store(syn, synapse_manifest, filehandles, verbose=False, ignore_errors=False
 
         i, x = row
         a = x.to_dict()
+        key = a.get('data_file')
+
+        if journal is not None and journal.is_complete(key):
+            continue
 
         if not file_handle.get('id'):
-            try:
-                stored_file_handle = syn.restPOST('/externalFileHandle/s3',
-                                                  json.dumps(file_handle),
-                                                  endpoint=syn.fileHandleEndpoint)
-                a['dataFileHandleId'] = stored_file_handle['id']
-            except Exception as e:
-                logger.error("File handle: %s" % (file_handle,))
-                if ignore_errors:
-                    continue
-                else:
-                    raise e
+            journal_file_handle_id = journal.file_handle(key) if journal is not None else None
+
+            if journal_file_handle_id:
+                a['dataFileHandleId'] = journal_file_handle_id
+            else:
+                try:
+                    with trace.span("synapse.create_filehandle", key=file_handle.get('key')):
+                        stored_file_handle = syn.restPOST('/externalFileHandle/s3',
+                                                          json.dumps(file_handle),
+                                                          endpoint=syn.fileHandleEndpoint)
+                    a['dataFileHandleId'] = stored_file_handle['id']
+                except Exception as e:
+                    logger.error("File handle: %s" % (file_handle,))
+                    if ignore_errors:
+                        continue
+                    else:
+                        raise e
+
+                if journal is not None:
+                    journal.record_file_handle(key, stored_file_handle['id'])
         else:
             if file_handle['id'] != a['dataFileHandleId']:
                 if ignore_errors:
@@ -167,10 +429,15 @@ def store(syn, synapse_manifest, filehandles, verbose=False, ignore_errors=False
                                                               a['dataFileHandleId']))
 
         f = synapseclient.File(**a)
-        f = syn.store(f, forceVersion=False)
+
+        with trace.span("synapse.store_entity", name=a.get('name')):
+            f = syn.store(f, forceVersion=False)
+
+        if journal is not None:
+            journal.record_entity(key, f.id, f.versionNumber)
 
         if verbose:
-            logger.debug("Stored %s (%s) to parentId %s" % (row.name, f.id, row.parentId))
+            logger.debug("Stored %s (%s) to parentId %s" % (x['name'], f.id, x['parentId']))
 
         f_list.append(f)
 
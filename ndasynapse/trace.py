@@ -0,0 +1,133 @@
+"""Span tracing of the sync pipeline, exportable as Chrome trace events.
+
+Tracing is off until `enable` is called. Each span records its name, start
+time, duration, process, thread, parent span and attributes. Export with
+`export_chrome_trace` and open the file in Perfetto or chrome://tracing.
+
+Spans started in a thread are children of the thread's enclosing span. Work
+handed to another thread can pass `parent=current_span()` explicitly.
+
+"""
+
+import os
+import json
+import time
+import functools
+import itertools
+import threading
+import contextlib
+
+_enabled = False
+_events = []
+_thread_names = {}
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def current_span():
+    """Get the id of the innermost span open in this thread, or None."""
+
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def _record(span_id, name, start, end, parent, attributes):
+    attributes.update(id=span_id, parent=parent)
+
+    event = dict(name=name, ph='X', ts=start * 1e6, dur=(end - start) * 1e6,
+                 pid=os.getpid(), tid=threading.current_thread().ident,
+                 args={k: str(v) if v is not None else None for k, v in attributes.items()})
+
+    with _lock:
+        _events.append(event)
+        _thread_names[event['tid']] = threading.current_thread().name
+
+
+def add_span(name, start, end, parent=None, **attributes):
+    """Record a span that was timed by the caller, with times from `time.time()`."""
+
+    if not _enabled:
+        return None
+
+    span_id = next(_ids)
+    _record(span_id, name, start, end, parent, attributes)
+
+    return span_id
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """Time a block of code as a span."""
+
+    if not _enabled:
+        yield None
+        return
+
+    stack = _stack()
+
+    if parent is None and stack:
+        parent = stack[-1]
+
+    span_id = next(_ids)
+    start = time.time()
+    stack.append(span_id)
+
+    try:
+        yield span_id
+    finally:
+        stack.pop()
+        _record(span_id, name, start, time.time(), parent, attributes)
+
+
+def traced(name=None):
+    """Decorator to record each call of a function as a span."""
+
+    def decorator(func):
+        span_name = name or "%s.%s" % (func.__module__.split(".")[-1], func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def export_chrome_trace(path):
+    """Write the recorded spans as a Chrome trace event JSON file."""
+
+    with _lock:
+        events = list(_events)
+        names = dict(_thread_names)
+
+    threads = {(x['pid'], x['tid']) for x in events}
+
+    metadata = [dict(name='thread_name', ph='M', pid=pid, tid=tid,
+                     args=dict(name=names.get(tid, str(tid))))
+                for (pid, tid) in threads]
+
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=metadata + events, displayTimeUnit='ms'), f)
@@ -15,5 +15,6 @@ setup(name='ndasynapse',
                         'boto>=2.46.1',
                         'requests>=2.18.1',
                         'deprecated==1.2.4'],
-      scripts=['bin/nda_to_synapse_manifest.py', 'bin/manifest_to_synapse.py', 'bin/query-nda'],
+      scripts=['bin/nda_to_synapse_manifest.py', 'bin/manifest_to_synapse.py', 'bin/query-nda',
+               'bin/query-nda-client', 'bin/nda_synapse_sync.py'],
       zip_safe=False)
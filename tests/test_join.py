@@ -0,0 +1,43 @@
+import pandas
+
+from ndasynapse import join
+
+
+def hash_join_all(*args, **kwargs):
+    return pandas.concat(join.hash_join(*args, **kwargs), ignore_index=True)
+
+
+def test_hash_join_matches_keys_of_different_dtypes(tmp_path):
+    left = pandas.DataFrame({'key': [1, 2, 3], 'a': ['x', 'y', 'z']})
+    right = pandas.DataFrame({'key': [1.0, 2.0, None], 'b': ['p', 'q', 'r']})
+
+    expected = left.merge(right, how='inner', on='key')
+    joined = hash_join_all(left, right, 'key', how='inner', partitions=8, tmp_dir=str(tmp_path))
+
+    assert expected.shape[0] == 2
+    assert sorted(joined.a) == sorted(expected.a)
+    assert sorted(joined.b) == sorted(expected.b)
+
+
+def test_hash_join_matches_int_and_string_keys(tmp_path):
+    left = pandas.DataFrame({'filename': ['1', '2', 'c'], 'a': [1, 2, 3]})
+    right = pandas.DataFrame({'data_file': [1, 2, 4], 'b': ['p', 'q', 's']})
+
+    joined = hash_join_all(left, right, 'filename', right_on='data_file', how='left',
+                           partitions=4, tmp_dir=str(tmp_path))
+    joined = joined.sort_values('a').reset_index(drop=True)
+
+    assert joined.b.tolist()[:2] == ['p', 'q']
+    assert pandas.isnull(joined.b[2])
+
+
+def test_hash_join_left_join_same_as_merge(tmp_path):
+    left = pandas.DataFrame({'k1': ['a', 'b', 'c', 'a'], 'k2': [1, 2, 3, 1], 'a': range(4)})
+    right = pandas.DataFrame({'k1': ['a', 'c', 'd'], 'k2': [1.0, 3.0, 4.0], 'b': ['p', 'q', 'r']})
+
+    expected = left.merge(right, how='left', on=['k1', 'k2'])
+    joined = hash_join_all(left, right, ['k1', 'k2'], how='left', partitions=3, tmp_dir=str(tmp_path))
+
+    assert list(joined.columns) == list(expected.columns)
+    assert joined.sort_values('a').b.tolist()[:3] == expected.sort_values('a').b.tolist()[:3]
+    assert joined.shape == expected.shape
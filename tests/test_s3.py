@@ -0,0 +1,71 @@
+import hashlib
+
+import boto3
+import pandas
+import pytest
+
+from ndasynapse import s3
+
+moto = pytest.importorskip("moto")
+
+BUCKET = 'nda-bsmn'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def md5(content):
+    return hashlib.md5(content).hexdigest()
+
+
+def test_verify_s3_objects_statuses(client, tmp_path):
+    content = b'abcdef'
+    client.put_object(Bucket=BUCKET, Key='a/ok.bam', Body=content)
+    client.put_object(Bucket=BUCKET, Key='a/size.bam', Body=content)
+    client.put_object(Bucket=BUCKET, Key='a/md5.bam', Body=content)
+
+    manifest = pandas.DataFrame({'data_file': ['s3://%s/a/ok.bam' % BUCKET, 's3://%s/a/missing.bam' % BUCKET,
+                                               's3://%s/a/size.bam' % BUCKET, 's3://%s/a/md5.bam' % BUCKET],
+                                 'size': [6, 6, 7, 6],
+                                 'md5': [md5(content), md5(content), md5(content), md5(b'other')]},
+                                index=[10, 11, 12, 13])
+
+    verified = s3.verify_s3_objects(manifest, {'bucket': BUCKET}, client=client, max_workers=2,
+                                    cache_dir=str(tmp_path))
+
+    assert verified.index.tolist() == [10, 11, 12, 13]
+    assert verified.s3_status.tolist() == [s3.STATUS_OK, s3.STATUS_MISSING,
+                                           s3.STATUS_SIZE_MISMATCH, s3.STATUS_MD5_MISMATCH]
+    assert verified.s3_md5[10] == md5(content)
+
+
+def test_verify_s3_objects_multipart_md5(client, tmp_path):
+    parts = [b'a' * (5 * 1024 * 1024), b'b' * 10]
+    upload = client.create_multipart_upload(Bucket=BUCKET, Key='multi.bam')
+    etags = [client.upload_part(Bucket=BUCKET, Key='multi.bam', UploadId=upload['UploadId'],
+                                PartNumber=n + 1, Body=part)['ETag']
+             for (n, part) in enumerate(parts)]
+    client.complete_multipart_upload(Bucket=BUCKET, Key='multi.bam', UploadId=upload['UploadId'],
+                                     MultipartUpload={'Parts': [{'ETag': etag, 'PartNumber': n + 1}
+                                                                for (n, etag) in enumerate(etags)]})
+
+    content = b''.join(parts)
+    manifest = pandas.DataFrame({'data_file': ['s3://%s/multi.bam' % BUCKET] * 2,
+                                 'size': [len(content)] * 2,
+                                 'md5': [md5(content), md5(b'other')]})
+
+    unchecked = s3.verify_s3_objects(manifest, {'bucket': BUCKET}, client=client, cache_dir=str(tmp_path))
+    assert unchecked.s3_status.tolist() == [s3.STATUS_OK, s3.STATUS_OK]
+
+    checked = s3.verify_s3_objects(manifest, {'bucket': BUCKET}, client=client, cache_dir=str(tmp_path),
+                                   compute_md5_multipart=True)
+    assert checked.s3_status.tolist() == [s3.STATUS_OK, s3.STATUS_MD5_MISMATCH]